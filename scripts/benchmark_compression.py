@@ -0,0 +1,177 @@
+"""
+Benchmarks the BGZF compression levels on sample outputs.
+
+Compresses a sample of VCF/BEDPE text, taken from plain or gzipped files
+and/or from the bgzipped members of a results archive, with the same BGZF
+writer the extractions use at each level, and reports the compression and
+decompression CPU time, output size and ratio per level. Use it to choose
+--compression_level and --intermediate_compression_level for your data and
+storage.
+"""
+import argparse
+import gzip
+import io
+import json
+import logging
+import sys
+import time
+
+from output_manifest import BgzfWriter
+from tar_members import iter_bgzf_member_lines, iter_bgzf_blocks, list_members
+
+# Members of a results archive sampled by default
+MEMBER_SUFFIXES = ['.vcf.gz', '.bedpe.gz']
+
+def read_file(path, limit):
+    """
+    Returns up to `limit` bytes of a plain or gzipped text file.
+    """
+    with open(path, 'rb') as fh:
+        gzipped = fh.read(2) == b'\x1f\x8b'
+    opener = gzip.open if gzipped else open
+    with opener(path, 'rb') as fh:
+        return fh.read(limit)
+
+def read_members(archive, suffixes, limit):
+    """
+    Returns up to `limit` bytes of the decompressed members of the archive
+    whose names end with one of `suffixes`, in archive order.
+    """
+    sample = bytearray()
+    for member in list_members(archive):
+        if not member.endswith(tuple(suffixes)):
+            continue
+        for line in iter_bgzf_member_lines(archive, member):
+            sample.extend(line)
+            if len(sample) >= limit:
+                return bytes(sample[:limit])
+    return bytes(sample)
+
+def load_sample(inputs, archive, suffixes, max_mb):
+    """
+    Concatenates the inputs and archive members into one sample of at most
+    `max_mb` MB.
+    """
+    limit = max_mb * 1024 * 1024
+    sample = bytearray()
+    for path in inputs:
+        sample.extend(read_file(path, limit - len(sample)))
+    if archive and len(sample) < limit:
+        sample.extend(read_members(archive, suffixes, limit - len(sample)))
+    return bytes(sample)
+
+def compress(sample, level):
+    """
+    Returns the sample as BGZF at `level` and the CPU seconds it took.
+    """
+    buf = io.BytesIO()
+    start = time.process_time()
+    writer = BgzfWriter(buf, level)
+    writer.write(sample)
+    writer.close()
+    return buf.getvalue(), time.process_time() - start
+
+def decompress(data):
+    """
+    Inflates BGZF data and returns the inflated size and the CPU seconds it
+    took.
+    """
+    start = time.process_time()
+    size = sum(len(i) for i in iter_bgzf_blocks(memoryview(data)))
+    return size, time.process_time() - start
+
+def benchmark(sample, levels, repeat):
+    """
+    Compresses the sample at every level and returns the results as a list
+    of dicts, keeping the fastest of `repeat` runs.
+    """
+    results = []
+    for level in levels:
+        best = None
+        for _ in range(repeat):
+            data, compress_seconds = compress(sample, level)
+            size, decompress_seconds = decompress(data)
+            assert size == len(sample), 'BGZF round trip lost data at level {0}'.format(level)
+            if best is None or compress_seconds < best['compress_seconds']:
+                best = {'level': level,
+                        'input_bytes': len(sample),
+                        'output_bytes': len(data),
+                        'ratio': len(sample) / float(len(data)),
+                        'compress_seconds': compress_seconds,
+                        'decompress_seconds': decompress_seconds}
+        results.append(best)
+    return results
+
+def report(results):
+    """
+    Logs a comparison table of the levels.
+    """
+    mb = 1024.0 * 1024.0
+    logger.info("{0:>5} {1:>10} {2:>7} {3:>12} {4:>12} {5:>12}".format(
+        'level', 'output_mb', 'ratio', 'compress_s', 'decompress_s', 'compress_mbs'))
+    for result in results:
+        logger.info("{0:>5} {1:>10.2f} {2:>7.2f} {3:>12.3f} {4:>12.3f} {5:>12.1f}".format(
+            result['level'], result['output_bytes'] / mb, result['ratio'],
+            result['compress_seconds'], result['decompress_seconds'],
+            result['input_bytes'] / mb / max(result['compress_seconds'], 1e-9)))
+
+def setup_logger():
+    """
+    Sets up the logger.
+    """
+    logger = logging.getLogger("benchmark_compression")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+if __name__ == '__main__':
+    """
+    CLI Entrypoint.
+    """
+    start = time.time()
+    logger = setup_logger()
+    logger.info("-"*80)
+    logger.info("benchmark_compression.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    p = argparse.ArgumentParser('Benchmark of the BGZF compression levels.')
+    p.add_argument('--input', action='append', default=[],
+                   help='Plain or gzipped text file to sample; can be repeated.')
+    p.add_argument('--results_archive', default=None,
+                   help='Sanger results tar archive whose bgzipped members are sampled.')
+    p.add_argument('--member_suffix', action='append', default=None,
+                   help='Suffix of the archive members to sample; can be repeated '
+                        '(default .vcf.gz and .bedpe.gz).')
+    p.add_argument('--levels', default='0,1,2,3,4,5,6,7,8,9',
+                   help='Comma separated compression levels (default 0-9).')
+    p.add_argument('--max_mb', type=int, default=256, help='Sample size cap in MB (default 256).')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Runs per level; the fastest is reported (default 1).')
+    p.add_argument('--output', default=None, help='Also write the results to this json file.')
+
+    args = p.parse_args()
+    if not args.input and not args.results_archive:
+        p.error('--input or --results_archive is required')
+    levels = [int(i) for i in args.levels.split(',')]
+    for level in levels:
+        if not -1 <= level <= 9:
+            p.error('Invalid compression level {0}'.format(level))
+
+    sample = load_sample(args.input, args.results_archive, args.member_suffix or MEMBER_SUFFIXES,
+                         args.max_mb)
+    assert sample, 'Nothing to sample'
+    logger.info("Sampled {0:.1f} MB".format(len(sample) / 1024.0 / 1024.0))
+
+    results = benchmark(sample, levels, args.repeat)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as o:
+            json.dump(results, o, indent=2, sort_keys=True)
+
+    # Done
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
@@ -0,0 +1,180 @@
+"""
+Benchmarks the I/O settings of the extractions on a results archive.
+
+Runs every caller extraction (and the non-standard variant filter on the
+caveman output) in this process once with small default-sized buffers and
+no read-ahead, and once with the large-buffer settings, and reports wall
+time, read/write syscalls and bytes from /proc/self/io for each. The
+archive is evicted from the page cache before each run where the kernel
+allows it, so the runs hit the filesystem rather than memory.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import buffered_io
+import extract_all
+import profiling
+import remove_nonstandard_variants
+import tar_members
+
+# Settings compared by the benchmark
+CONFIGS = [
+    ('small', {'read_buffer_size': io.DEFAULT_BUFFER_SIZE,
+               'write_buffer_size': io.DEFAULT_BUFFER_SIZE,
+               'read_ahead_window': 0}),
+    ('large', buffered_io.get_config())
+]
+
+def read_proc_io():
+    """
+    Returns the I/O counters of this process (all threads), or an empty dict
+    where /proc/self/io isn't available.
+    """
+    try:
+        with open('/proc/self/io', 'r') as fh:
+            return dict((k, int(v)) for k, v in (line.split(':') for line in fh))
+    except (IOError, OSError):
+        return {}
+
+def evict(path):
+    """
+    Drops the clean pages of a file from the page cache.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        buffered_io.fadvise(fd, 0, 0, getattr(os, 'POSIX_FADV_DONTNEED', 4))
+    finally:
+        os.close(fd)
+
+def run_tasks(archive, out_dir, gdcaliquot):
+    """
+    Yields (task name, function) pairs running each extraction.
+    """
+    options = {
+        'remove_nonstandard_variants': False,
+        'gdcaliquot': gdcaliquot,
+        'bgzip_segments': True,
+        'resume': False,
+        'profile': None,
+        'profile_mode': profiling.SAMPLING,
+        'profile_memory': False,
+        'catalog': None
+    }
+    for caller in extract_all.CALLERS:
+        prefix = os.path.join(out_dir, caller)
+        yield caller, lambda caller=caller, prefix=prefix: extract_all.RUNNERS[caller](archive, prefix, options)
+
+    filter_args = argparse.Namespace(
+        input_vcf=os.path.join(out_dir, 'caveman.vcf.gz'),
+        output_filename=os.path.join(out_dir, 'nonstandard.vcf.gz'),
+        output_format='auto', skip_index=False, sidecar_prefix=None,
+        profile=None, profile_mode=profiling.SAMPLING, profile_memory=False, catalog=None,
+        read_buffer_mb=None, write_buffer_mb=None, compression_level=None,
+        intermediate_compression_level=None)
+    filter_logger = logging.getLogger('remove_nonstandard_variants')
+    yield 'remove_nonstandard_variants', lambda: remove_nonstandard_variants.main(filter_args, filter_logger)
+
+def benchmark(archive, gdcaliquot, repeat, workdir=None):
+    """
+    Runs all tasks with every config and returns the results as a list of
+    dicts, keeping the fastest of `repeat` runs.
+    """
+    results = []
+    for name, config in CONFIGS:
+        out_dir = tempfile.mkdtemp(prefix='benchmark_io_', dir=workdir)
+        try:
+            best = {}
+            for _ in range(repeat):
+                buffered_io.configure(**config)
+                tar_members._ARCHIVE_INDEX.clear()
+                evict(archive)
+                for task, func in run_tasks(archive, out_dir, gdcaliquot):
+                    before = read_proc_io()
+                    start = time.time()
+                    func()
+                    elapsed = time.time() - start
+                    after = read_proc_io()
+                    result = dict(('{0}_delta'.format(k), after[k] - before[k]) for k in after)
+                    result.update({'config': name, 'task': task, 'seconds': elapsed})
+                    if task not in best or elapsed < best[task]['seconds']:
+                        best[task] = result
+            results.extend(best[task] for task, _ in run_tasks(archive, out_dir, gdcaliquot))
+        finally:
+            shutil.rmtree(out_dir)
+    return results
+
+def report(results):
+    """
+    Logs a comparison table of the configs per task.
+    """
+    mb = 1024.0 * 1024.0
+    logger.info("{0:<28} {1:<6} {2:>9} {3:>9} {4:>9} {5:>10} {6:>10}".format(
+        'task', 'config', 'seconds', 'syscr', 'syscw', 'read_mb', 'write_mb'))
+    for result in sorted(results, key=lambda i: (i['task'], i['config'])):
+        logger.info("{0:<28} {1:<6} {2:>9.3f} {3:>9} {4:>9} {5:>10.1f} {6:>10.1f}".format(
+            result['task'], result['config'], result['seconds'],
+            result.get('syscr_delta', 'n/a'), result.get('syscw_delta', 'n/a'),
+            result.get('rchar_delta', 0) / mb, result.get('wchar_delta', 0) / mb))
+
+def init_loggers():
+    """
+    The benchmarked modules log through module level loggers that are
+    normally created in their CLI entrypoints. Only errors are shown.
+    """
+    for module in (extract_all.extract_caveman_vcf, extract_all.extract_pindel_vcf,
+                   extract_all.extract_brass_vcf, extract_all.extract_brass_bedpe):
+        extract_all.init_module_logger(module)
+        module.logger.setLevel(logging.ERROR)
+    logging.getLogger('remove_nonstandard_variants').setLevel(logging.ERROR)
+
+def setup_logger():
+    """
+    Sets up the logger.
+    """
+    logger = logging.getLogger("benchmark_io")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+if __name__ == '__main__':
+    """
+    CLI Entrypoint.
+    """
+    start = time.time()
+    logger = setup_logger()
+    logger.info("-"*80)
+    logger.info("benchmark_io.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    p = argparse.ArgumentParser('Benchmark of the small and large buffer I/O settings.')
+    p.add_argument('--results_archive', required=True, help='Sanger results tar archive.')
+    p.add_argument('--gdcaliquot', default='BENCHMARK', help='GDC Aliquot ID for the ascat output.')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Runs per config; the fastest is reported (default 1).')
+    p.add_argument('--workdir', default=None,
+                   help='Directory for the outputs, e.g. on the filesystem under test (default tmp).')
+    p.add_argument('--output', default=None, help='Also write the results to this json file.')
+
+    args = p.parse_args()
+    init_loggers()
+
+    results = benchmark(args.results_archive, args.gdcaliquot, args.repeat, args.workdir)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as o:
+            json.dump(results, o, indent=2, sort_keys=True)
+
+    # Done
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
@@ -0,0 +1,179 @@
+"""
+Large-buffer file I/O for network filesystems.
+
+On NFS/Lustre every read or write syscall is a round trip, so inputs and
+outputs are opened with buffers of several MB, inputs get sequential access
+hints, writes are coalesced into few large syscalls, and members of an
+uncompressed archive are read ahead by a background thread while they are
+being processed.
+
+The sizes are process wide and set once by the scripts' --read_buffer_mb
+and --write_buffer_mb options through configure().
+"""
+import os
+import sys
+import threading
+
+# Default buffer sizes in bytes
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+# How far the read-ahead thread may get ahead of the reader; 0 disables it
+READ_AHEAD_WINDOW = 64 * 1024 * 1024
+
+_config = {
+    'read_buffer_size': READ_BUFFER_SIZE,
+    'write_buffer_size': WRITE_BUFFER_SIZE,
+    'read_ahead_window': READ_AHEAD_WINDOW
+}
+
+def configure(read_buffer_size=None, write_buffer_size=None, read_ahead_window=None):
+    """
+    Sets the process wide buffer sizes in bytes. None keeps the current value.
+    """
+    for key, value in (('read_buffer_size', read_buffer_size),
+                       ('write_buffer_size', write_buffer_size),
+                       ('read_ahead_window', read_ahead_window)):
+        if value is not None:
+            _config[key] = value
+
+def configure_from_args(args):
+    """
+    Applies the --read_buffer_mb and --write_buffer_mb options of a script.
+    """
+    mb = 1024 * 1024
+    configure(read_buffer_size=args.read_buffer_mb * mb if args.read_buffer_mb else None,
+              write_buffer_size=args.write_buffer_mb * mb if args.write_buffer_mb else None)
+
+def get_config():
+    """
+    Returns a copy of the current settings, e.g. to pass to worker processes.
+    """
+    return dict(_config)
+
+def fadvise(fd, offset, length, advice):
+    """
+    posix_fadvise where the platform has it; the hints are optional.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+def open_read(path):
+    """
+    Opens a file for sequential reading with a large buffer.
+    """
+    fh = open(path, 'rb', buffering=_config['read_buffer_size'])
+    if hasattr(os, 'POSIX_FADV_SEQUENTIAL'):
+        fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    return fh
+
+def open_write(path):
+    """
+    Opens a file (or named pipe) for writing with a large buffer, so many
+    small writes are coalesced into few syscalls.
+    """
+    return open(path, 'wb', buffering=_config['write_buffer_size'])
+
+def open_stdout():
+    """
+    Large-buffer binary writer on stdout. It must be flushed, not closed.
+    """
+    sys.stdout.flush()
+    return open(sys.stdout.fileno(), 'wb', buffering=_config['write_buffer_size'], closefd=False)
+
+def prefetch(path, offset, size):
+    """
+    Asks the kernel to start reading a region of a file in the background,
+    e.g. the next archive member while the current one is processed.
+    """
+    if hasattr(os, 'POSIX_FADV_WILLNEED') and size:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            fadvise(fd, offset, size, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+class ReadAhead(object):
+    """
+    Reads a region of a file into the page cache from a background thread,
+    staying at most `window` bytes ahead of the position the consumer
+    reports through advance(). Meant for memory mapped archive members,
+    where page faults would otherwise fetch one small read-ahead window at a
+    time. Chunks are requested with POSIX_FADV_WILLNEED, so nothing is
+    copied into the process; without it they are read and discarded.
+    """
+    def __init__(self, path, offset, size, window=None, chunk_size=None):
+        self.path = path
+        self.offset = offset
+        self.end = offset + size
+        self.window = _config['read_ahead_window'] if window is None else window
+        self.chunk_size = chunk_size or _config['read_buffer_size']
+        self._position = offset
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the read-ahead thread, unless disabled or the region fits
+        in a single window.
+        """
+        if self.window and self.end - self.offset > self.chunk_size:
+            self._thread = threading.Thread(target=self._run, name='read-ahead')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _run(self):
+        """
+        Thread body, pulls chunk after chunk into the page cache.
+        """
+        willneed = getattr(os, 'POSIX_FADV_WILLNEED', None)
+        if not hasattr(os, 'posix_fadvise'):
+            willneed = None
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            pos = self.offset
+            while pos < self.end:
+                with self._cond:
+                    while not self._closed and pos - self._position > self.window:
+                        self._cond.wait()
+                    if self._closed:
+                        return
+                size = min(self.chunk_size, self.end - pos)
+                if willneed is not None:
+                    fadvise(fd, pos, size, willneed)
+                elif not os.pread(fd, size, pos):
+                    return
+                pos += size
+        finally:
+            os.close(fd)
+
+    def advance(self, consumed):
+        """
+        Reports that the consumer has processed `consumed` bytes of the region.
+        """
+        with self._cond:
+            self._position = self.offset + consumed
+            self._cond.notify()
+
+    def close(self):
+        """
+        Stops the read-ahead thread.
+        """
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
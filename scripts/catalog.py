@@ -0,0 +1,180 @@
+"""
+Local SQLite catalog of archive contents and produced outputs.
+
+Scripts given --catalog record the members of the archive they read (name,
+offset, size) and, for every finished run, its outputs with checksums and
+record counts, the filter counts and the stage timings. The catalog can be
+queried with query_catalog.py to plan reruns without rescanning archives.
+"""
+from contextlib import contextmanager
+import os
+import sqlite3
+import time
+from urllib.request import pathname2url
+
+from output_manifest import is_stream
+from tar_members import list_member_info
+
+# Seconds to wait for concurrent writers (e.g. the extract_all.py workers)
+LOCK_TIMEOUT = 120
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS archives (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    cataloged REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS members (
+    archive_id INTEGER NOT NULL REFERENCES archives(id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (archive_id, name)
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    archive_id INTEGER REFERENCES archives(id) ON DELETE CASCADE,
+    input TEXT NOT NULL,
+    caller TEXT NOT NULL,
+    output_prefix TEXT,
+    finished REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    file_name TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    md5sum TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    record_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS filter_counts (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    reason TEXT NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_timings (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    stage TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS members_name ON members(name);
+CREATE INDEX IF NOT EXISTS runs_archive ON runs(archive_id, caller);
+"""
+
+def connect(path):
+    """
+    Opens the catalog in autocommit mode, creating the tables if needed.
+    """
+    conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT, isolation_level=None)
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+def connect_read_only(path):
+    """
+    Opens an existing catalog read-only. Unlike connect() it never creates
+    the database, so a mistyped path fails instead of reading an empty one.
+    """
+    uri = 'file:{0}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+    return sqlite3.connect(uri, uri=True, timeout=LOCK_TIMEOUT)
+
+@contextmanager
+def transaction(path):
+    """
+    Yields a connection inside a write transaction. The write lock is taken
+    up front so concurrent writers queue instead of racing between a read
+    and the following write.
+    """
+    conn = connect(path)
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+def get_archive(conn, path):
+    """
+    Returns the (id, size, mtime) of a cataloged archive, or None.
+    """
+    return conn.execute('SELECT id, size, mtime FROM archives WHERE path = ?', (path,)).fetchone()
+
+class Catalog(object):
+    """
+    Records archives and runs in the catalog at `path`. With path None
+    nothing is recorded.
+    """
+    def __init__(self, path=None):
+        self.path = path
+
+    def record_archive(self, archive):
+        """
+        Records the members of an archive, unless the catalog already has them
+        for an archive of the same size and mtime. Returns the archive id.
+        """
+        if not self.path:
+            return None
+        st = os.stat(archive)
+        path = os.path.abspath(archive)
+        conn = connect(self.path)
+        try:
+            row = get_archive(conn, path)
+        finally:
+            conn.close()
+        if row and row[1] == st.st_size and row[2] == st.st_mtime:
+            return row[0]
+
+        # Scan before taking the write lock; the scan is cached per process
+        members = list_member_info(archive)
+        with transaction(self.path) as conn:
+            row = get_archive(conn, path)
+            if row and row[1] == st.st_size and row[2] == st.st_mtime:
+                return row[0]
+            if row:
+                archive_id = row[0]
+                conn.execute('UPDATE archives SET size = ?, mtime = ?, cataloged = ? WHERE id = ?',
+                             (st.st_size, st.st_mtime, time.time(), archive_id))
+                conn.execute('DELETE FROM members WHERE archive_id = ?', (archive_id,))
+            else:
+                archive_id = conn.execute(
+                    'INSERT INTO archives (path, size, mtime, cataloged) VALUES (?, ?, ?, ?)',
+                    (path, st.st_size, st.st_mtime, time.time())).lastrowid
+            conn.executemany('INSERT OR REPLACE INTO members (archive_id, name, offset, size) '
+                             'VALUES (?, ?, ?, ?)',
+                             [(archive_id, name, offset, size) for name, offset, size in members])
+        return archive_id
+
+    def record_run(self, caller, input_path, entries, output_prefix=None, filter_counts=None,
+                   timings=None, archive=None):
+        """
+        Records a finished run of `caller` over `input_path`: the manifest
+        entries of its outputs, its filter counts and its stage timings. If
+        the input is a results archive its members are recorded too.
+        """
+        if not self.path:
+            return None
+        archive_id = self.record_archive(archive) if archive else None
+        if not is_stream(input_path):
+            input_path = os.path.abspath(input_path)
+        with transaction(self.path) as conn:
+            run_id = conn.execute(
+                'INSERT INTO runs (archive_id, input, caller, output_prefix, finished) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (archive_id, input_path, caller,
+                 output_prefix and os.path.abspath(output_prefix), time.time())).lastrowid
+            conn.executemany(
+                'INSERT INTO outputs (run_id, file_name, file_size, md5sum, sha256, record_count) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(run_id, i['file_name'], i['file_size'], i['md5sum'], i['sha256'], i['record_count'])
+                 for i in entries])
+            conn.executemany('INSERT INTO filter_counts (run_id, reason, count) VALUES (?, ?, ?)',
+                             [(run_id, k, v) for k, v in (filter_counts or {}).items()])
+            conn.executemany('INSERT INTO stage_timings (run_id, stage, seconds) VALUES (?, ?, ?)',
+                             [(run_id, k, v) for k, v in (timings or {}).items()])
+        return run_id
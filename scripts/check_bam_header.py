@@ -16,6 +16,10 @@ import pysam
 import argparse
 import logging
 
+from catalog import Catalog
+from output_manifest import file_stats
+from profiling import MODES, SAMPLING, Profiler
+
 PLATFORM = "ILLUMINA"
 
 
@@ -24,15 +28,21 @@ def main(args: argparse.Namespace) -> None:
     Main wrapper for processing bam file headers.
     """
     logger.info("Extracting bam header...")
-    bam = pysam.AlignmentFile(args.input_bam, mode="rb")
-    try:
-        pass_sm = check_samples(bam)
-        pass_pl = check_platforms(bam)
-        conditionally_generate_new_header(
-            bam, pass_sm, pass_pl, args.aliquot_id, args.output_header
-        )
-    finally:
-        bam.close()
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
+    with profiler.stage("header"):
+        bam = pysam.AlignmentFile(args.input_bam, mode="rb")
+        try:
+            pass_sm = check_samples(bam)
+            pass_pl = check_platforms(bam)
+            written = conditionally_generate_new_header(
+                bam, pass_sm, pass_pl, args.aliquot_id, args.output_header
+            )
+        finally:
+            bam.close()
+    outputs = [file_stats(args.output_header)] if written else []
+    Catalog(args.catalog).record_run(
+        "bam_header", args.input_bam, outputs, timings=profiler.timings
+    )
 
 
 def check_samples(bam: pysam.AlignmentFile) -> bool:
@@ -75,12 +85,14 @@ def conditionally_generate_new_header(
     pass_pl: bool,
     aliquot_id: str,
     out_file: str,
-) -> None:
+) -> bool:
     """
     If pass_sm or pass_pl are False, generates the new bam header, otherwise does nothing.
+    Returns True if the header was written.
     """
     if pass_sm and pass_pl:
         logger.info("No issues detected. No header written.")
+        return False
     else:
         logger.info("Detected RG problems, will create new header.")
         fix_header = {}
@@ -99,6 +111,7 @@ def conditionally_generate_new_header(
 
         obam = pysam.AlignmentFile(out_file, mode="w", header=fix_header)
         obam.close()
+        return True
 
 
 def setup_logger():
@@ -140,6 +153,30 @@ if __name__ == "__main__":
         required=True,
         help="Output header file name if a new header is needed.",
     )
+    p.add_argument(
+        "--profile",
+        default=None,
+        metavar="PREFIX",
+        help="Profile the run, writing {PREFIX}.header.collapsed (or .pstats) files.",
+    )
+    p.add_argument(
+        "--profile_mode",
+        choices=MODES,
+        default=SAMPLING,
+        help="sampling (default) writes sampled call stacks with little overhead, "
+        "deterministic writes cProfile stats with exact call counts but runs much slower.",
+    )
+    p.add_argument(
+        "--profile_memory",
+        action="store_true",
+        help="With --profile, also write tracemalloc allocation hotspots to "
+        "{PREFIX}.header.alloc.tsv.",
+    )
+    p.add_argument(
+        "--catalog",
+        default=None,
+        help="SQLite catalog to record the run in (see query_catalog.py).",
+    )
 
     args = p.parse_args()
 
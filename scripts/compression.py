@@ -0,0 +1,51 @@
+"""
+BGZF compression level policy.
+
+Each BGZF output has a role: final deliverables keep zlib's default level,
+while intermediates that are re-read right away (e.g. a caveman VCF piped
+into remove_nonstandard_variants.py) default to a fast level. Level 0
+writes uncompressed BGZF blocks that htslib still reads and indexes.
+Use benchmark_compression.py to pick levels for your data.
+"""
+import zlib
+
+# Output roles
+FINAL = 'final'
+INTERMEDIATE = 'intermediate'
+
+# Default level per role
+DEFAULT_LEVELS = {
+    FINAL: zlib.Z_DEFAULT_COMPRESSION,
+    INTERMEDIATE: 1
+}
+
+_levels = dict(DEFAULT_LEVELS)
+
+def configure_levels(final_level=None, intermediate_level=None):
+    """
+    Overrides the final and/or intermediate compression level (-1 to 9).
+    """
+    for role, level in ((FINAL, final_level), (INTERMEDIATE, intermediate_level)):
+        if level is not None:
+            if not -1 <= level <= 9:
+                raise ValueError("Invalid compression level {0}".format(level))
+            _levels[role] = level
+
+def configure_levels_from_args(args):
+    """
+    Applies --compression_level and, if the script has it, --intermediate_compression_level.
+    """
+    configure_levels(final_level=args.compression_level,
+                     intermediate_level=getattr(args, 'intermediate_compression_level', None))
+
+def get_levels():
+    """
+    Returns the compression level of each role.
+    """
+    return dict(_levels)
+
+def get_level(role=FINAL):
+    """
+    Returns the compression level for outputs of the given role.
+    """
+    return _levels[role]
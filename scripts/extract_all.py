@@ -0,0 +1,274 @@
+"""
+Runs the caveman, pindel, brass vcf, brass bedpe and ascat extractions of a
+sanger results archive concurrently, one worker process per caller.
+
+The archive is scanned once and the member lookup is shared with the
+workers. The number of concurrent workers is bounded by a core and memory
+budget, and the run fails if any caller fails.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import redirect_stdout
+import logging
+import os
+import sys
+import time
+
+import extract_ascat
+import extract_brass_bedpe
+import extract_brass_vcf
+import extract_caveman_vcf
+import extract_pindel_vcf
+from buffered_io import configure, configure_from_args, get_config
+from catalog import Catalog
+from compression import FINAL, configure_levels, configure_levels_from_args, get_levels
+from profiling import MODES, SAMPLING, Profiler
+from tar_members import index_archive, load_archive_index
+
+# Callers, most expensive first so the slowest one starts right away
+CALLERS = ['caveman', 'pindel', 'brass_vcf', 'brass_bedpe', 'ascat']
+
+# Default memory estimate per worker. The extractions stream their inputs so
+# this is dominated by the interpreter, pysam and the compression buffers.
+JOB_MEMORY_MB = 512
+
+def init_module_logger(module):
+    """
+    The caller scripts log through a module level logger that is normally
+    created in their CLI entrypoint.
+    """
+    if getattr(module, 'logger', None) is None:
+        module.logger = module.setup_logger()
+    return module
+
+def get_profile_prefix(caller, options):
+    """
+    Prefix for the stage profiles of one caller, or None if not profiling.
+    """
+    if options['profile']:
+        return '{0}.{1}'.format(options['profile'], caller)
+    return None
+
+def get_profiler(caller, options):
+    """
+    Profiler for the stages of one caller.
+    """
+    return Profiler(get_profile_prefix(caller, options), mode=options['profile_mode'],
+                    memory=options['profile_memory'])
+
+def run_caveman(archive, prefix, options):
+    """
+    Extracts the caveman vcf, see extract_caveman_vcf.py.
+    """
+    mod = init_module_logger(extract_caveman_vcf)
+    vcf, vcf_index = mod.extract_tar_keys(archive)
+    mod.process_vcf(archive, vcf, vcf_index, prefix,
+                    remove_nonstandard=options['remove_nonstandard_variants'],
+                    resume=options['resume'], profiler=get_profiler('caveman', options),
+                    catalog=Catalog(options['catalog']))
+
+def run_pindel(archive, prefix, options):
+    """
+    Extracts the pindel vcf, see extract_pindel_vcf.py.
+    """
+    mod = init_module_logger(extract_pindel_vcf)
+    vcf, vcf_index = mod.extract_tar_keys(archive)
+    mod.process_vcf(archive, vcf, vcf_index, prefix, resume=options['resume'],
+                    profiler=get_profiler('pindel', options), catalog=Catalog(options['catalog']))
+
+def run_brass_vcf(archive, prefix, options):
+    """
+    Extracts the brass vcf, see extract_brass_vcf.py.
+    """
+    mod = init_module_logger(extract_brass_vcf)
+    vcf, vcf_index = mod.extract_tar_keys(archive)
+    mod.process_vcf(archive, vcf, vcf_index, prefix, resume=options['resume'],
+                    profiler=get_profiler('brass_vcf', options), catalog=Catalog(options['catalog']))
+
+def run_brass_bedpe(archive, prefix, options):
+    """
+    Extracts the brass bedpe, see extract_brass_bedpe.py.
+    """
+    mod = init_module_logger(extract_brass_bedpe)
+    bedpe, bedpe_index = mod.extract_tar_keys(archive)
+    mod.process_bedpe(archive, bedpe, bedpe_index, prefix, resume=options['resume'],
+                      profiler=get_profiler('brass_bedpe', options), catalog=Catalog(options['catalog']))
+
+def run_ascat(archive, prefix, options):
+    """
+    Extracts the ascat segments and stats, see extract_ascat.py.
+    """
+    output = '{0}.copynumber.tsv'.format(prefix)
+    if options['bgzip_segments']:
+        output += '.gz'
+    args = argparse.Namespace(input=archive, output=output, gdcaliquot=options['gdcaliquot'],
+                              bgzip=options['bgzip_segments'],
+                              profile=get_profile_prefix('ascat', options),
+                              profile_mode=options['profile_mode'],
+                              profile_memory=options['profile_memory'],
+                              catalog=options['catalog'])
+    extract_ascat.reformat_copynumber(args)
+    with open('{0}.stats.json'.format(prefix), 'w') as o, redirect_stdout(o):
+        extract_ascat.extract_stats(args)
+
+RUNNERS = {
+    'caveman': run_caveman,
+    'pindel': run_pindel,
+    'brass_vcf': run_brass_vcf,
+    'brass_bedpe': run_brass_bedpe,
+    'ascat': run_ascat
+}
+
+def run_caller(caller, archive, archive_index, output_prefix, options):
+    """
+    Worker entrypoint. Runs one caller's extraction using the archive index
+    from the parent process. Returns the caller name and elapsed seconds.
+    """
+    start = time.time()
+    configure(**options['io'])
+    configure_levels(final_level=options['compression'][FINAL])
+    load_archive_index(archive, archive_index)
+    RUNNERS[caller](archive, '{0}.{1}'.format(output_prefix, caller), options)
+    return caller, time.time() - start
+
+def get_max_workers(n_jobs, cores, memory_mb, job_memory_mb):
+    """
+    Number of workers that fits in the core and memory budget.
+    """
+    workers = min(n_jobs, cores)
+    if memory_mb:
+        workers = min(workers, memory_mb // job_memory_mb)
+        if workers < 1:
+            logger.warning("Memory budget of {0} MB is below the {1} MB estimate per worker, "
+                           "running one caller at a time.".format(memory_mb, job_memory_mb))
+    return max(1, workers)
+
+def main(args):
+    """
+    Main wrapper for running all caller extractions concurrently.
+    """
+    configure_from_args(args)
+    configure_levels_from_args(args)
+    callers = args.callers.split(',') if args.callers else CALLERS
+    unknown = set(callers) - set(CALLERS)
+    assert not unknown, 'Unknown callers {0}'.format(','.join(sorted(unknown)))
+    callers = [i for i in CALLERS if i in callers]
+    if 'ascat' in callers:
+        assert args.gdcaliquot, '--gdcaliquot is required for ascat'
+
+    logger.info("Indexing archive members...")
+    archive_index = index_archive(args.results_archive)
+    if args.catalog:
+        logger.info("Recording archive members in catalog {0}".format(args.catalog))
+        Catalog(args.catalog).record_archive(args.results_archive)
+
+    options = {
+        'remove_nonstandard_variants': args.remove_nonstandard_variants,
+        'gdcaliquot': args.gdcaliquot,
+        'bgzip_segments': args.bgzip_segments,
+        'resume': args.resume,
+        'profile': args.profile,
+        'profile_mode': args.profile_mode,
+        'profile_memory': args.profile_memory,
+        'catalog': args.catalog,
+        'io': get_config(),
+        'compression': get_levels()
+    }
+    workers = get_max_workers(len(callers), args.cores, args.memory_mb, args.job_memory_mb)
+    logger.info("Running {0} with {1} workers...".format(','.join(callers), workers))
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for caller in callers:
+            future = executor.submit(run_caller, caller, args.results_archive, archive_index,
+                                     args.output_prefix, options)
+            futures[future] = caller
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                caller = futures[future]
+                try:
+                    _, elapsed = future.result()
+                    logger.info("Finished {0}, took {1} seconds.".format(caller, elapsed))
+                except Exception:
+                    logger.exception("Failed {0}".format(caller))
+                    failed.append(caller)
+
+    if failed:
+        logger.error("Failed callers: {0}".format(','.join(failed)))
+    return 1 if failed else 0
+
+def setup_logger():
+    """
+    Sets up the logger.
+    """
+    logger = logging.getLogger("extract_all")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+if __name__ == '__main__':
+    """
+    CLI Entrypoint.
+    """
+    start = time.time()
+    logger = setup_logger()
+    logger.info("-"*80)
+    logger.info("extract_all.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    p = argparse.ArgumentParser('Utility for running all extractions of a sanger results archive concurrently.')
+    p.add_argument('--results_archive', required=True, help='Sanger results tar archive.')
+    p.add_argument('--output_prefix', required=True,
+                   help='Prefix for all outputs. Each caller writes to {output_prefix}.{caller}.*')
+    p.add_argument('--gdcaliquot', default=None, help='GDC Aliquot ID, required for ascat.')
+    p.add_argument('--callers', default=None,
+                   help='Comma separated subset of {0} (default all).'.format(','.join(CALLERS)))
+    p.add_argument('--cores', type=int, default=os.cpu_count() or 1,
+                   help='Maximum number of concurrent workers (default all cores).')
+    p.add_argument('--memory_mb', type=int, default=None,
+                   help='Total memory budget in MB for the workers (default unbounded).')
+    p.add_argument('--job_memory_mb', type=int, default=JOB_MEMORY_MB,
+                   help='Memory estimate per worker in MB (default {0}).'.format(JOB_MEMORY_MB))
+    p.add_argument('--remove_nonstandard_variants', action='store_true',
+                   help='Remove non-ACGT alleles from the caveman vcf in the same pass.')
+    p.add_argument('--bgzip_segments', action='store_true',
+                   help='bgzip and tabix index the ascat segment file.')
+    p.add_argument('--resume', action='store_true',
+                   help='Checkpoint finished stages of the vcf and bedpe extractions and skip them '
+                        'when restarted with the same inputs.')
+    p.add_argument('--profile', default=None, metavar='PREFIX',
+                   help='Profile each stage of each caller, writing {PREFIX}.{caller}.{stage}.collapsed '
+                        '(or .pstats) files.')
+    p.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                   help='sampling (default) writes sampled call stacks with little overhead, deterministic '
+                        'writes cProfile stats with exact call counts but runs much slower.')
+    p.add_argument('--profile_memory', action='store_true',
+                   help='With --profile, also write tracemalloc allocation hotspots to '
+                        '{PREFIX}.{caller}.{stage}.alloc.tsv.')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to record the archive members and the outputs of each caller in '
+                        '(see query_catalog.py).')
+    p.add_argument('--read_buffer_mb', type=int, default=None,
+                   help='Read buffer size in MB (default 8).')
+    p.add_argument('--write_buffer_mb', type=int, default=None,
+                   help='Write buffer size in MB (default 8).')
+    p.add_argument('--compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of the outputs (default zlib\'s 6).')
+
+    args = p.parse_args()
+
+    # Process
+    logger.info("Processing results tar archive {0}...".format(args.results_archive))
+    status = main(args)
+
+    # Done
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
+    sys.exit(status)
@@ -10,9 +10,20 @@ import argparse
 import json
 import logging
 import sys
-import tarfile
 import time
 
+from buffered_io import configure_from_args
+from catalog import Catalog
+from compression import configure_levels_from_args
+from output_manifest import OutputFile, index_output, write_manifest
+from profiling import MODES, SAMPLING, Profiler
+from tar_members import iter_member_lines, list_members
+
+# 0-based columns of the chromosome, start and end in the GDC segment file
+SEG_SEQ_COL = 1
+SEG_START_COL = 2
+SEG_END_COL = 3
+
 def get_file_from_tar(tar_path, file_name):
     """
     Using a partial or full file name, get the full path of the file within the tar.
@@ -20,10 +31,9 @@ def get_file_from_tar(tar_path, file_name):
     @param file_name: full file name or end of the filename to find
     @return the path for the file
     """
-    with tarfile.open(tar_path, 'r') as tar_fh:
-        for i in tar_fh.getmembers():
-            if i.name.endswith(file_name):
-                return i.name
+    for name in list_members(tar_path):
+        if name.endswith(file_name):
+            return name
 
 def reformat_copynumber(args):
     """
@@ -31,49 +41,65 @@ def reformat_copynumber(args):
     @param input: path to Sanger output tar file
     @param output: path to write the output
     @param gdcaliquot: aliquot id used to generate the Sanger tar
+    @param bgzip: write the output bgzipped with a tabix index (see query_segments.py)
+    @param profile: prefix for per-stage profiles, or None
+    @param profile_mode: sampling or deterministic profiling
+    @param profile_memory: also record allocation hotspots in the profiles
+    @param catalog: SQLite catalog to record the run in, or None
     @return writes a file
     """
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
     seg_path = get_file_from_tar(args.input, 'copynumber.caveman.csv')
-    with tarfile.open(args.input, 'r') as tar_fh:
-        fobj = tar_fh.extractfile(seg_path)
-        try:
-            with open(args.output, 'w') as o:
-                o.write('\t'.join(["GDC_Aliquot","Chromosome","Start","End","Copy_Number","Major_Copy_Number","Minor_Copy_Number\n"]))
-                while True:
-                    rline = fobj.readline()
-                    if not rline: break
-                    line = rline.strip().decode('utf-8').split(',')
-                    chrom = 'chr' + line[1]
-                    start = line[2]
-                    end = line[3]
-                    copy_number = int(line[6])
-                    minor_cn = int(line[7])
-                    major_cn = copy_number - minor_cn 
-                    wline = '\t'.join([args.gdcaliquot, chrom, start, end, str(copy_number), str(major_cn), str(minor_cn)])
-                    o.write(wline+'\n')
-        finally:
-            fobj.close()
+    o = OutputFile(args.output, compress=args.bgzip)
+    try:
+        with profiler.stage('transformed'):
+            o.write('\t'.join(["GDC_Aliquot","Chromosome","Start","End","Copy_Number","Major_Copy_Number","Minor_Copy_Number\n"]).encode('utf-8'))
+            for rline in iter_member_lines(args.input, seg_path):
+                line = rline.strip().decode('utf-8').split(',')
+                chrom = 'chr' + line[1]
+                start = line[2]
+                end = line[3]
+                copy_number = int(line[6])
+                minor_cn = int(line[7])
+                major_cn = copy_number - minor_cn 
+                wline = '\t'.join([args.gdcaliquot, chrom, start, end, str(copy_number), str(major_cn), str(minor_cn)])
+                o.write_record((wline+'\n').encode('utf-8'))
+    finally:
+        o.close()
+    o.commit()
+
+    manifest = [o.stats()]
+    if args.bgzip:
+        # 1-based inclusive coordinates, skipping the column header line
+        with profiler.stage('indexed'):
+            manifest.append(index_output(args.output, seq_col=SEG_SEQ_COL, start_col=SEG_START_COL,
+                                         end_col=SEG_END_COL, line_skip=1, zerobased=False))
+    write_manifest('{0}.manifest.json'.format(args.output), manifest)
+    Catalog(args.catalog).record_run('ascat_copynumber', args.input, manifest, output_prefix=args.output,
+                                     timings=profiler.timings, archive=args.input)
 
 def extract_stats(args):
     """
     Take the Sanger output ascat sample statistics file and extract two values.
     @param input: path to Sanger output tar file
+    @param profile: prefix for per-stage profiles, or None
+    @param profile_mode: sampling or deterministic profiling
+    @param profile_memory: also record allocation hotspots in the profiles
+    @param catalog: SQLite catalog to record the run in, or None
     @return output_json: stdout json object containing stats for tumor_purity and ploidy
     """
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
     output_json = {}
     stats_path = get_file_from_tar(args.input, 'samplestatistics.txt')
-    with tarfile.open(args.input, 'r') as tar_fh:
-       fobj = tar_fh.extractfile(stats_path)
-       try:
-           lines = fobj.readlines()
-           for line in lines:
-               if line.strip().decode('utf-8').split(' ')[0] == 'NormalContamination':
-                   output_json['tumor_purity'] = 1 - float(line.strip().decode('utf-8').split(' ')[1])
-               elif line.strip().decode('utf-8').split(' ')[0] == 'Ploidy':
-                   output_json['ploidy'] = float(line.strip().decode('utf-8').split(' ')[1])
-       finally:
-           fobj.close()   
+    with profiler.stage('stats'):
+       for line in iter_member_lines(args.input, stats_path):
+           if line.strip().decode('utf-8').split(' ')[0] == 'NormalContamination':
+               output_json['tumor_purity'] = 1 - float(line.strip().decode('utf-8').split(' ')[1])
+           elif line.strip().decode('utf-8').split(' ')[0] == 'Ploidy':
+               output_json['ploidy'] = float(line.strip().decode('utf-8').split(' ')[1])
     print(json.dumps(output_json))
+    Catalog(args.catalog).record_run('ascat_stats', args.input, [], timings=profiler.timings,
+                                     archive=args.input)
 
 def setup_logger():
     """
@@ -109,15 +135,39 @@ def main():
     seg_subparser.add_argument('--input', '-i', help='path to file output from Sanger pipeline')
     seg_subparser.add_argument('--output', '-o', help='path for output file')
     seg_subparser.add_argument('--gdcaliquot', '-g', help='GDC Aliquot ID used to generate the file')
+    seg_subparser.add_argument('--bgzip', action='store_true',
+                               help='bgzip the output and tabix index it for query_segments.py')
+    seg_subparser.add_argument('--profile', metavar='PREFIX',
+                               help='profile each stage, writing {PREFIX}.{stage}.collapsed (or .pstats) files')
+    seg_subparser.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                               help='sampled call stacks (default) or slower, exact cProfile stats')
+    seg_subparser.add_argument('--profile_memory', action='store_true',
+                               help='with --profile, also write allocation hotspots to {PREFIX}.{stage}.alloc.tsv')
+    seg_subparser.add_argument('--catalog', help='SQLite catalog to record the archive members and outputs in')
+    seg_subparser.add_argument('--read_buffer_mb', type=int, help='read buffer size in MB (default 8)')
+    seg_subparser.add_argument('--write_buffer_mb', type=int, help='write buffer size in MB (default 8)')
+    seg_subparser.add_argument('--compression_level', type=int, choices=range(-1, 10), metavar='{0-9}',
+                               help='BGZF compression level with --bgzip (default zlib\'s 6)')
     seg_subparser.set_defaults(func=reformat_copynumber)
 
     stat_subparser = subparsers.add_parser('extract_stats')
     stat_subparser.add_argument('--input', '-i', help='path to file output from Sanger pipeline')
+    stat_subparser.add_argument('--profile', metavar='PREFIX',
+                                help='profile the run, writing {PREFIX}.stats.collapsed (or .pstats) files')
+    stat_subparser.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                                help='sampled call stacks (default) or slower, exact cProfile stats')
+    stat_subparser.add_argument('--profile_memory', action='store_true',
+                                help='with --profile, also write allocation hotspots to {PREFIX}.stats.alloc.tsv')
+    stat_subparser.add_argument('--catalog', help='SQLite catalog to record the archive members in')
+    stat_subparser.add_argument('--read_buffer_mb', type=int, help='read buffer size in MB (default 8)')
+    stat_subparser.set_defaults(write_buffer_mb=None, compression_level=None)
     stat_subparser.set_defaults(func=extract_stats)
 
     args = parser.parse_args()
 
     logger.info("Processing results tar archive {0}...".format(args.input))
+    configure_from_args(args)
+    configure_levels_from_args(args)
     args.func(args) 
 
     logger.info("Finished, took {0} seconds.".format(time.time() - start))
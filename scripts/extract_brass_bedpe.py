@@ -6,21 +6,33 @@ Extracts and processes the brass bedpe file.
 import os
 import time
 import sys
-import tarfile
 import pysam
 import argparse
 import logging 
 
+from buffered_io import configure_from_args, get_config
+from catalog import Catalog
+from compression import configure_levels_from_args, get_level
+from output_manifest import OutputFile, index_output, write_manifest
+from profiling import MODES, SAMPLING, Profiler
+from run_state import RunState, archive_inputs
+from tar_members import list_members, iter_member_chunks, prefetch_member
+
 def main(args):
     """
     Main wrapper for processing the brass bedpe outputs.
     """
+    configure_from_args(args)
+    configure_levels_from_args(args)
     # Extract keys
     logger.info("Extracting brass bedpe file key from tarfile...")
     bedpe, bedpe_index = extract_tar_keys(args.results_archive)
     # process bedpe
     logger.info("Processing brass bedpe {0}...".format(bedpe))
-    process_bedpe(args.results_archive, bedpe, bedpe_index, args.output_prefix)
+    process_bedpe(args.results_archive, bedpe, bedpe_index, args.output_prefix, resume=args.resume,
+                  profiler=Profiler(args.profile, mode=args.profile_mode,
+                                    memory=args.profile_memory),
+                  catalog=Catalog(args.catalog))
 
 def format_header(line):
     """
@@ -43,69 +55,107 @@ def format_header(line):
             cols.append(item.lower().replace(' ', '_').replace('/', '_').replace('-', '_'))
     return cols
 
-def process_bedpe(archive, bedpe, bedpe_index, output_prefix):
+def process_bedpe(archive, bedpe, bedpe_index, output_prefix, resume=False, profiler=None,
+                  catalog=None):
     """
     Extracts and processes the brass bedpe file.
+
+    With `resume`, finished stages are checkpointed in {output_prefix}.bedpe.state.json
+    and skipped when the job is restarted. Stages are profiled with `profiler`
+    and the run is recorded in `catalog` if given.
     """
+    profiler = profiler or Profiler()
+    catalog = catalog or Catalog()
     out_raw_bedpe = '{0}.tmp.bedpe.gz'.format(output_prefix)
-    logger.info("Extracting raw bedpe to tmp file {0}".format(out_raw_bedpe))
-    extract_file(archive, bedpe, out_raw_bedpe)
-
     out_raw_bedpe_index = '{0}.tmp.bedpe.gz.tbi'.format(output_prefix)
-    logger.info("Extracting raw bedpe index to tmp file {0}".format(out_raw_bedpe_index))
-    extract_file(archive, bedpe_index, out_raw_bedpe_index)
-
     out_formatted_bedpe = '{0}.bedpe.gz'.format(output_prefix)
-    logger.info("Creating final bedpe {0}".format(out_formatted_bedpe))
-    writer = pysam.BGZFile(out_formatted_bedpe, mode='wb')
-    reader = pysam.BGZFile(out_raw_bedpe, mode='rb')
-    try:
-        meta_line = None
-        process_header = False
-        hdr = []
-        for line in reader:
-            line = line.decode('utf-8')
-            if line.startswith('#'):
-                meta_line = line
-            else:
-                if not process_header:
-                    hdr = format_header(meta_line)
-                    assert len(hdr) == len(set(hdr)), \
-                        "Duplicate header keys {0}".format(','.join(hdr))
-                    writer.write(('#' + '\t'.join(hdr) + '\n').encode('utf-8'))
-                    process_header = True
-
-                dat = dict(zip(hdr, line.rstrip('\r\n').split('\t')))
-                dat['brass_notation'] = dat['brass_notation'].replace('Chr.chr', 'chr')
-                new_line = "\t".join([dat[i] for i in hdr]) + '\n'
-                writer.write(new_line.encode('utf-8'))
-    finally:
-        writer.close()
-        reader.close()
+    state = RunState('{0}.bedpe.state.json'.format(output_prefix) if resume else None,
+                     archive_inputs(archive, [bedpe, bedpe_index], [out_raw_bedpe, out_formatted_bedpe],
+                                    compression_level=get_level()))
+
+    if state.is_done('transformed'):
+        logger.info("Reusing final bedpe {0} from a previous run".format(out_formatted_bedpe))
+    else:
+        if state.is_done('extracted'):
+            logger.info("Reusing raw bedpe tmp files from a previous run")
+        else:
+            with profiler.stage('extracted'):
+                # Have the kernel fetch the index member while the bedpe is copied
+                prefetch_member(archive, bedpe_index)
+                logger.info("Extracting raw bedpe to tmp file {0}".format(out_raw_bedpe))
+                raw_entry = extract_file(archive, bedpe, out_raw_bedpe)
+
+                logger.info("Extracting raw bedpe index to tmp file {0}".format(out_raw_bedpe_index))
+                raw_index_entry = extract_file(archive, bedpe_index, out_raw_bedpe_index)
+            state.mark_done('extracted', [(out_raw_bedpe, raw_entry), (out_raw_bedpe_index, raw_index_entry)])
+
+        logger.info("Creating final bedpe {0}".format(out_formatted_bedpe))
+        writer = OutputFile(out_formatted_bedpe)
+        reader = pysam.BGZFile(out_raw_bedpe, mode='rb')
+        try:
+            with profiler.stage('transformed'):
+                meta_line = None
+                process_header = False
+                hdr = []
+                for line in reader:
+                    line = line.decode('utf-8')
+                    if line.startswith('#'):
+                        meta_line = line
+                    else:
+                        if not process_header:
+                            hdr = format_header(meta_line)
+                            assert len(hdr) == len(set(hdr)), \
+                                "Duplicate header keys {0}".format(','.join(hdr))
+                            writer.write(('#' + '\t'.join(hdr) + '\n').encode('utf-8'))
+                            process_header = True
+
+                        dat = dict(zip(hdr, line.rstrip('\r\n').split('\t')))
+                        dat['brass_notation'] = dat['brass_notation'].replace('Chr.chr', 'chr')
+                        new_line = "\t".join([dat[i] for i in hdr]) + '\n'
+                        writer.write_record(new_line.encode('utf-8'))
+        finally:
+            writer.close()
+            reader.close()
+        writer.commit()
+        state.mark_done('transformed', [(out_formatted_bedpe, writer.stats())])
 
     # tabix index
-    logger.info("Creating final bedpe index {0}".format(out_formatted_bedpe + '.tbi'))
-    pysam.tabix_index( out_formatted_bedpe, preset='bed', force=True )
+    if state.is_done('indexed'):
+        logger.info("Reusing final bedpe index {0} from a previous run".format(out_formatted_bedpe + '.tbi'))
+    else:
+        logger.info("Creating final bedpe index {0}".format(out_formatted_bedpe + '.tbi'))
+        with profiler.stage('indexed'):
+            index_entry = index_output(out_formatted_bedpe, preset='bed')
+        state.mark_done('indexed', [(out_formatted_bedpe + '.tbi', index_entry)])
+
+    # manifest
+    out_manifest = '{0}.bedpe.manifest.json'.format(output_prefix)
+    logger.info("Writing output manifest {0}".format(out_manifest))
+    manifest = state.entries('transformed') + state.entries('indexed')
+    write_manifest(out_manifest, manifest)
+    catalog.record_run('brass_bedpe', archive, manifest, output_prefix=output_prefix,
+                       timings=profiler.timings, archive=archive)
 
     # clean up
     logger.info("Cleaning up tmp files...")
-    os.remove(out_raw_bedpe)
-    os.remove(out_raw_bedpe_index)
+    for path in [out_raw_bedpe, out_raw_bedpe_index]:
+        if os.path.exists(path):
+            os.remove(path)
 
 def extract_file(tar, key, output_path):
     """
-    Extracts a file from the tar to a particular path.
+    Extracts a file from the tar to a particular path. The file only appears
+    under output_path once it is complete. Returns its manifest entry.
     """
-    with tarfile.open(tar, 'r') as tar_fh:
-        fobj = tar_fh.extractfile(key)
-        try:
-            with open(output_path, 'wb') as o:
-                while True:
-                    chunk = fobj.read(1024)
-                    if not chunk: break
-                    o.write(chunk)
-        finally:
-            fobj.close()
+    o = OutputFile(output_path, compress=False)
+    try:
+        # Chunks of the write buffer size go straight to the file uncopied
+        for chunk in iter_member_chunks(tar, key, chunk_size=get_config()['write_buffer_size']):
+            o.write(chunk)
+    finally:
+        o.close()
+    o.commit()
+    return o.stats()
      
 def extract_tar_keys(tar):
     """
@@ -113,17 +163,16 @@ def extract_tar_keys(tar):
     """
     bedpe = None
     bedpe_index = None
-    with tarfile.open(tar, 'r') as tar_fh:
-        for item in tar_fh.getnames():
-            if '/brass/' in item:
-                if item.endswith('.annot.bedpe.gz'):
-                    bedpe = item
-                    logger.info("Found brass bedpe key: {0}".format(bedpe))
-                elif item.endswith('.annot.bedpe.gz.tbi'):
-                    bedpe_index = item
-                    logger.info("Found brass bedpe index key: {0}".format(bedpe_index))
-                if bedpe and bedpe_index:
-                    break
+    for item in list_members(tar):
+        if '/brass/' in item:
+            if item.endswith('.annot.bedpe.gz'):
+                bedpe = item
+                logger.info("Found brass bedpe key: {0}".format(bedpe))
+            elif item.endswith('.annot.bedpe.gz.tbi'):
+                bedpe_index = item
+                logger.info("Found brass bedpe index key: {0}".format(bedpe_index))
+            if bedpe and bedpe_index:
+                break
     assert bedpe is not None, 'Unable to find brass bedpe file in {0}'.format(tar)
     assert bedpe_index is not None, 'Unable to find brass bedpe index file in {0}'.format(tar)
     return bedpe, bedpe_index
@@ -155,6 +204,26 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser('Utility for extracting brass bedpe file from sanger results archive.')
     p.add_argument('--results_archive', required=True, help='Sanger results tar archive.')
     p.add_argument('--output_prefix', required=True, help='Prefix for all outputs.')
+    p.add_argument('--resume', action='store_true',
+                   help='Checkpoint finished stages in {output_prefix}.bedpe.state.json and skip them '
+                        'when restarted with the same inputs.')
+    p.add_argument('--profile', default=None, metavar='PREFIX',
+                   help='Profile each stage, writing {PREFIX}.{stage}.collapsed (or .pstats) files.')
+    p.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                   help='sampling (default) writes sampled call stacks with little overhead, deterministic '
+                        'writes cProfile stats with exact call counts but runs much slower.')
+    p.add_argument('--profile_memory', action='store_true',
+                   help='With --profile, also write tracemalloc allocation hotspots to '
+                        '{PREFIX}.{stage}.alloc.tsv.')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to record the archive members and outputs of this run in '
+                        '(see query_catalog.py).')
+    p.add_argument('--read_buffer_mb', type=int, default=None,
+                   help='Read buffer size in MB (default 8).')
+    p.add_argument('--write_buffer_mb', type=int, default=None,
+                   help='Write buffer size in MB (default 8).')
+    p.add_argument('--compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of the outputs (default zlib\'s 6).')
 
     args = p.parse_args()
 
@@ -3,104 +3,101 @@ Extracts and processes the brass VCF file.
 
 @author: Kyle Hernandez
 """
-import os
 import time
 import sys
-import tarfile
-import pysam
 import argparse
 import logging 
 
+from buffered_io import configure_from_args
+from catalog import Catalog
+from compression import configure_levels_from_args, get_level
+from output_manifest import OutputFile, index_output, write_manifest
+from profiling import MODES, SAMPLING, Profiler
+from run_state import RunState, archive_inputs
+from tar_members import list_members, iter_bgzf_member_lines
+from vcf_filters import VcfFilterChain, rename_tumour_sample
+
 def main(args):
     """
     Main wrapper for processing the brass VCF outputs.
     """
+    configure_from_args(args)
+    configure_levels_from_args(args)
     # Extract keys
     logger.info("Extracting brass vcf file key from tarfile...")
     vcf, vcf_index = extract_tar_keys(args.results_archive)
     # process vcf
     logger.info("Processing brass vcf {0}...".format(vcf))
-    process_vcf(args.results_archive, vcf, vcf_index, args.output_prefix)
+    process_vcf(args.results_archive, vcf, vcf_index, args.output_prefix, resume=args.resume,
+                profiler=Profiler(args.profile, mode=args.profile_mode,
+                                  memory=args.profile_memory),
+                catalog=Catalog(args.catalog))
 
-def process_vcf(archive, vcf, vcf_index, output_prefix):
+def process_vcf(archive, vcf, vcf_index, output_prefix, resume=False, profiler=None,
+                catalog=None):
     """
     Extracts and processes the brass vcf file.
-    """
-    out_raw_vcf = '{0}.tmp.vcf.gz'.format(output_prefix)
-    logger.info("Extracting raw vcf to tmp file {0}".format(out_raw_vcf))
-    extract_file(archive, vcf, out_raw_vcf)
-
-    out_raw_vcf_index = '{0}.tmp.vcf.gz.tbi'.format(output_prefix)
-    logger.info("Extracting raw vcf index to tmp file {0}".format(out_raw_vcf_index))
-    extract_file(archive, vcf_index, out_raw_vcf_index)
+    `vcf_index` is unused since the output is indexed anew.
 
-    # Update the sample name using BGZFile which doesn't assert any VCF format
-    logger.info("Processing raw VCF to change TUMOUR -> TUMOR...")
+    With `resume`, finished stages are checkpointed in {output_prefix}.vcf.state.json
+    and skipped when the job is restarted. Stages are profiled with `profiler`
+    and the run is recorded in `catalog` if given.
+    """
+    profiler = profiler or Profiler()
+    catalog = catalog or Catalog()
     out_formatted_vcf = '{0}.vcf.gz'.format(output_prefix)
-    logger.info("Creating final vcf {0}".format(out_formatted_vcf))
-    writer = pysam.BGZFile(out_formatted_vcf, mode='wb')
-    reader = pysam.BGZFile(out_raw_vcf, mode='rb') 
-    try:
-        for line in reader:
-            line = line.decode('utf-8')
-            if line.startswith('##'):
-                if line.startswith('##SAMPLE=<ID=TUMOUR'):
-                    new_line = line.replace('ID=TUMOUR', 'ID=TUMOR') + '\n'
-                    writer.write(new_line.encode('utf-8'))
-                else:
-                    new_line = line + '\n'
-                    writer.write(new_line.encode('utf-8') )
-            elif line.startswith('#CHROM'):
-                new_line = line.replace('TUMOUR', 'TUMOR') + '\n'
-                writer.write(new_line.encode('utf-8'))
-            else:
-                new_line = line + '\n'
-                writer.write(new_line.encode('utf-8'))
-    finally:
-        writer.close()
-        reader.close()
+    state = RunState('{0}.vcf.state.json'.format(output_prefix) if resume else None,
+                     archive_inputs(archive, [vcf], [out_formatted_vcf], compression_level=get_level()))
+
+    if state.is_done('transformed'):
+        logger.info("Reusing final vcf {0} from a previous run".format(out_formatted_vcf))
+    else:
+        # Stream straight from the archive member; no tmp copy of the raw vcf
+        logger.info("Processing raw VCF to change TUMOUR -> TUMOR...")
+        logger.info("Creating final vcf {0}".format(out_formatted_vcf))
+        writer = OutputFile(out_formatted_vcf)
+        try:
+            with profiler.stage('transformed'):
+                chain = VcfFilterChain(header_transforms=[rename_tumour_sample])
+                chain.run(iter_bgzf_member_lines(archive, vcf), writer)
+        finally:
+            writer.close()
+        writer.commit()
+        state.mark_done('transformed', [(out_formatted_vcf, writer.stats())])
 
     # tabix index
-    logger.info("Creating final vcf index {0}".format(out_formatted_vcf + '.tbi'))
-    pysam.tabix_index( out_formatted_vcf, preset='vcf', force=True )
+    if state.is_done('indexed'):
+        logger.info("Reusing final vcf index {0} from a previous run".format(out_formatted_vcf + '.tbi'))
+    else:
+        logger.info("Creating final vcf index {0}".format(out_formatted_vcf + '.tbi'))
+        with profiler.stage('indexed'):
+            index_entry = index_output(out_formatted_vcf, preset='vcf')
+        state.mark_done('indexed', [(out_formatted_vcf + '.tbi', index_entry)])
 
-    # clean up
-    logger.info("Cleaning up tmp files...")
-    os.remove(out_raw_vcf)
-    os.remove(out_raw_vcf_index)
+    # manifest
+    out_manifest = '{0}.vcf.manifest.json'.format(output_prefix)
+    logger.info("Writing output manifest {0}".format(out_manifest))
+    manifest = state.entries('transformed') + state.entries('indexed')
+    write_manifest(out_manifest, manifest)
+    catalog.record_run('brass_vcf', archive, manifest, output_prefix=output_prefix,
+                       timings=profiler.timings, archive=archive)
 
-def extract_file(tar, key, output_path):
-    """
-    Extracts a file from the tar to a particular path.
-    """
-    with tarfile.open(tar, 'r') as tar_fh:
-        fobj = tar_fh.extractfile(key)
-        try:
-            with open(output_path, 'wb') as o:
-                while True:
-                    chunk = fobj.read(1024)
-                    if not chunk: break
-                    o.write(chunk)
-        finally:
-            fobj.close()
-     
 def extract_tar_keys(tar):
     """
     Extracts the relevant brass keys from the tar archive.
     """
     vcf = None
     vcf_index = None
-    with tarfile.open(tar, 'r') as tar_fh:
-        for item in tar_fh.getnames():
-            if '/brass/' in item:
-                if item.endswith('.annot.vcf.gz'):
-                    vcf = item
-                    logger.info("Found brass vcf key: {0}".format(vcf))
-                elif item.endswith('.annot.vcf.gz.tbi'):
-                    vcf_index = item
-                    logger.info("Found brass vcf index key: {0}".format(vcf_index))
-                if vcf and vcf_index:
-                    break
+    for item in list_members(tar):
+        if '/brass/' in item:
+            if item.endswith('.annot.vcf.gz'):
+                vcf = item
+                logger.info("Found brass vcf key: {0}".format(vcf))
+            elif item.endswith('.annot.vcf.gz.tbi'):
+                vcf_index = item
+                logger.info("Found brass vcf index key: {0}".format(vcf_index))
+            if vcf and vcf_index:
+                break
     assert vcf is not None, 'Unable to find brass vcf file in {0}'.format(tar)
     assert vcf_index is not None, 'Unable to find brass vcf index file in {0}'.format(tar)
     return vcf, vcf_index
@@ -132,6 +129,26 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser('Utility for extracting brass files from sanger results archive.')
     p.add_argument('--results_archive', required=True, help='Sanger results tar archive.')
     p.add_argument('--output_prefix', required=True, help='Prefix for all outputs.')
+    p.add_argument('--resume', action='store_true',
+                   help='Checkpoint finished stages in {output_prefix}.vcf.state.json and skip them '
+                        'when restarted with the same inputs.')
+    p.add_argument('--profile', default=None, metavar='PREFIX',
+                   help='Profile each stage, writing {PREFIX}.{stage}.collapsed (or .pstats) files.')
+    p.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                   help='sampling (default) writes sampled call stacks with little overhead, deterministic '
+                        'writes cProfile stats with exact call counts but runs much slower.')
+    p.add_argument('--profile_memory', action='store_true',
+                   help='With --profile, also write tracemalloc allocation hotspots to '
+                        '{PREFIX}.{stage}.alloc.tsv.')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to record the archive members and outputs of this run in '
+                        '(see query_catalog.py).')
+    p.add_argument('--read_buffer_mb', type=int, default=None,
+                   help='Read buffer size in MB (default 8).')
+    p.add_argument('--write_buffer_mb', type=int, default=None,
+                   help='Write buffer size in MB (default 8).')
+    p.add_argument('--compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of the outputs (default zlib\'s 6).')
 
     args = p.parse_args()
 
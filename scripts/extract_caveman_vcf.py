@@ -3,110 +3,128 @@ Extracts and processes the caveman VCF file.
 
 @author: Kyle Hernandez
 """
-import os
 import time
 import sys
-import tarfile
-import pysam
 import argparse
 import logging 
 
+from buffered_io import configure_from_args
+from catalog import Catalog
+from compression import FINAL, INTERMEDIATE, configure_levels_from_args, get_level
+from filtered_records import FilteredRecordLog
+from output_manifest import OutputFile, index_output, is_stream, write_manifest
+from profiling import MODES, SAMPLING, Profiler
+from run_state import RunState, archive_inputs
+from tar_members import list_members, iter_bgzf_member_lines
+from vcf_filters import caveman_filter_chain
+
 def main(args):
     """
     Main wrapper for processing the caveman VCF outputs.
     """
+    configure_from_args(args)
+    configure_levels_from_args(args)
     # Extract keys
     logger.info("Extracting caveman vcf file key from tarfile...")
     vcf, vcf_index = extract_tar_keys(args.results_archive)
     # process vcf
     logger.info("Processing caveman vcf {0}...".format(vcf))
-    process_vcf(args.results_archive, vcf, vcf_index, args.output_prefix)
+    process_vcf(args.results_archive, vcf, vcf_index, args.output_prefix,
+                remove_nonstandard=args.remove_nonstandard_variants,
+                output_vcf=args.output_stream,
+                compress=args.output_format == 'bgzf',
+                index=not args.skip_index,
+                intermediate=args.intermediate,
+                resume=args.resume,
+                profiler=Profiler(args.profile, mode=args.profile_mode,
+                                  memory=args.profile_memory),
+                catalog=Catalog(args.catalog))
 
-def process_vcf(archive, vcf, vcf_index, output_prefix):
-    """
-    Extracts and processes the caveman vcf file.
+def process_vcf(archive, vcf, vcf_index, output_prefix, remove_nonstandard=False,
+                output_vcf=None, compress=True, index=True, intermediate=False, resume=False,
+                profiler=None, catalog=None):
     """
-    out_raw_vcf = '{0}.tmp.vcf.gz'.format(output_prefix)
-    logger.info("Extracting raw vcf to tmp file {0}".format(out_raw_vcf))
-    extract_file(archive, vcf, out_raw_vcf)
+    Extracts and processes the caveman vcf file in a single pass: TUMOUR -> TUMOR,
+    removal of ref == alt loci and, optionally, removal of non-ACGT alleles.
+    `vcf_index` is unused since the output is indexed anew.
 
-    out_raw_vcf_index = '{0}.tmp.vcf.gz.tbi'.format(output_prefix)
-    logger.info("Extracting raw vcf index to tmp file {0}".format(out_raw_vcf_index))
-    extract_file(archive, vcf_index, out_raw_vcf_index)
+    The vcf is written to `output_vcf` if given (a path, named pipe or '-' for
+    stdout), otherwise to {output_prefix}.vcf.gz. Streams are never indexed.
+    Streams and `intermediate` vcfs are compressed at the intermediate level.
+    With `resume`, finished stages are checkpointed in {output_prefix}.state.json
+    and skipped when the job is restarted. Stages are profiled with `profiler`
+    and the run is recorded in `catalog` if given.
+    """
+    profiler = profiler or Profiler()
+    catalog = catalog or Catalog()
+    out_formatted_vcf = output_vcf or '{0}.vcf.gz'.format(output_prefix)
+    out_filtered = '{0}.filtered.tsv.gz'.format(output_prefix)
+    index = index and compress and not is_stream(out_formatted_vcf)
+    resume = resume and not is_stream(out_formatted_vcf)
+    level = get_level(INTERMEDIATE if intermediate else FINAL)
+    state = RunState('{0}.state.json'.format(output_prefix) if resume else None,
+                     archive_inputs(archive, [vcf], [out_formatted_vcf, out_filtered],
+                                    remove_nonstandard=remove_nonstandard,
+                                    compress=compress, compression_level=level))
 
-    # Update the sample name using BGZFile which doesn't assert any VCF format
-    logger.info("Processing raw VCF to change TUMOUR -> TUMOR...")
-    out_formatted_vcf = '{0}.vcf.gz'.format(output_prefix)
-    logger.info("Creating final vcf {0}".format(out_formatted_vcf))
-    writer = pysam.BGZFile(out_formatted_vcf, mode='wb')
-    reader = pysam.BGZFile(out_raw_vcf, mode='rb') 
-    try:
-        for line in reader:
-            line = line.decode('utf-8')
-            if line.startswith('##'):
-                if line.startswith('##SAMPLE=<ID=TUMOUR'):
-                    new_line = line.replace('ID=TUMOUR', 'ID=TUMOR') + '\n'
-                    writer.write(new_line.encode('utf-8'))
-                else:
-                    new_line = line + '\n'
-                    writer.write(new_line.encode('utf-8') )
-            elif line.startswith('#CHROM'):
-                new_line = line.replace('TUMOUR', 'TUMOR') + '\n'
-                writer.write(new_line.encode('utf-8'))
-            else:
-                # BINF-306: fix rare case of alt == ref in caveman vcf.
-                cols = line.split('\t')
-                if cols[3] == cols[4]:
-                    logger.warn("Removing loci {0}:{1} where ref and alt alleles are same: {2} - {3}".format(
-                        cols[0], cols[1], cols[3], cols[4]))
-                    continue
-                new_line = line + '\n'
-                writer.write(new_line.encode('utf-8'))
-    finally:
-        writer.close()
-        reader.close()
+    if state.is_done('transformed'):
+        logger.info("Reusing final vcf {0} from a previous run".format(out_formatted_vcf))
+    else:
+        # Stream straight from the archive member; no tmp copy of the raw vcf
+        logger.info("Processing raw VCF to change TUMOUR -> TUMOR...")
+        if remove_nonstandard:
+            logger.info("Removing non-standard variants in the same pass...")
+        logger.info("Creating final vcf {0}".format(out_formatted_vcf))
+        writer = OutputFile(out_formatted_vcf, compress=compress, intermediate=intermediate)
+        filtered = FilteredRecordLog(out_filtered, logger)
+        try:
+            with profiler.stage('transformed'):
+                chain = caveman_filter_chain(remove_nonstandard)
+                chain.run(iter_bgzf_member_lines(archive, vcf), writer, filtered)
+        finally:
+            writer.close()
+            filtered.close()
+        writer.commit()
+        filtered.commit()
+        state.mark_done('transformed', [(out_formatted_vcf, writer.stats()), (out_filtered, filtered.stats())],
+                        filter_counts=filtered.counts)
 
-    # tabix index
-    logger.info("Creating final vcf index {0}".format(out_formatted_vcf + '.tbi'))
-    pysam.tabix_index( out_formatted_vcf, preset='vcf', force=True )
+    manifest = state.entries('transformed')
+    if index:
+        # tabix index
+        if state.is_done('indexed'):
+            logger.info("Reusing final vcf index {0} from a previous run".format(out_formatted_vcf + '.tbi'))
+        else:
+            logger.info("Creating final vcf index {0}".format(out_formatted_vcf + '.tbi'))
+            with profiler.stage('indexed'):
+                index_entry = index_output(out_formatted_vcf, preset='vcf')
+            state.mark_done('indexed', [(out_formatted_vcf + '.tbi', index_entry)])
+        manifest.extend(state.entries('indexed'))
 
-    # clean up
-    logger.info("Cleaning up tmp files...")
-    os.remove(out_raw_vcf)
-    os.remove(out_raw_vcf_index)
+    # manifest
+    out_manifest = '{0}.manifest.json'.format(output_prefix)
+    logger.info("Writing output manifest {0}".format(out_manifest))
+    filter_counts = state.get('transformed', 'filter_counts')
+    write_manifest(out_manifest, manifest, filter_counts=filter_counts)
+    catalog.record_run('caveman', archive, manifest, output_prefix=output_prefix,
+                       filter_counts=filter_counts, timings=profiler.timings, archive=archive)
 
-def extract_file(tar, key, output_path):
-    """
-    Extracts a file from the tar to a particular path.
-    """
-    with tarfile.open(tar, 'r') as tar_fh:
-        fobj = tar_fh.extractfile(key)
-        try:
-            with open(output_path, 'wb') as o:
-                while True:
-                    chunk = fobj.read(1024)
-                    if not chunk: break
-                    o.write(chunk)
-        finally:
-            fobj.close()
-     
 def extract_tar_keys(tar):
     """
     Extracts the relevant caveman keys from the tar archive.
     """
     vcf = None
     vcf_index = None
-    with tarfile.open(tar, 'r') as tar_fh:
-        for item in tar_fh.getnames():
-            if '/caveman/' in item:
-                if item.endswith('.flagged.muts.vcf.gz'):
-                    vcf = item
-                    logger.info("Found caveman vcf key: {0}".format(vcf))
-                elif item.endswith('.flagged.muts.vcf.gz.tbi'):
-                    vcf_index = item
-                    logger.info("Found caveman vcf index key: {0}".format(vcf_index))
-                if vcf and vcf_index:
-                    break
+    for item in list_members(tar):
+        if '/caveman/' in item:
+            if item.endswith('.flagged.muts.vcf.gz'):
+                vcf = item
+                logger.info("Found caveman vcf key: {0}".format(vcf))
+            elif item.endswith('.flagged.muts.vcf.gz.tbi'):
+                vcf_index = item
+                logger.info("Found caveman vcf index key: {0}".format(vcf_index))
+            if vcf and vcf_index:
+                break
     assert vcf is not None, 'Unable to find caveman vcf file in {0}'.format(tar)
     assert vcf_index is not None, 'Unable to find caveman vcf index file in {0}'.format(tar)
     return vcf, vcf_index
@@ -138,6 +156,43 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser('Utility for extracting caveman files from sanger results archive.')
     p.add_argument('--results_archive', required=True, help='Sanger results tar archive.')
     p.add_argument('--output_prefix', required=True, help='Prefix for all outputs.')
+    p.add_argument('--remove_nonstandard_variants', action='store_true',
+                   help='Also remove non-ACGT alleles in the same pass (replaces a separate '
+                        'remove_nonstandard_variants.py run).')
+    p.add_argument('--output_stream', default=None,
+                   help='Write the vcf here instead of {output_prefix}.vcf.gz. Can be a named pipe '
+                        'or - for stdout. Sidecar files still use --output_prefix.')
+    p.add_argument('--output_format', choices=['bgzf', 'vcf'], default='bgzf',
+                   help='Write the vcf bgzipped (default) or uncompressed.')
+    p.add_argument('--skip_index', action='store_true',
+                   help='Do not tabix index the vcf, e.g. to index it later. Implied for '
+                        'uncompressed output, named pipes and stdout.')
+    p.add_argument('--resume', action='store_true',
+                   help='Checkpoint finished stages in {output_prefix}.state.json and skip them '
+                        'when restarted with the same inputs. Ignored for streamed output.')
+    p.add_argument('--profile', default=None, metavar='PREFIX',
+                   help='Profile each stage, writing {PREFIX}.{stage}.collapsed (or .pstats) files.')
+    p.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                   help='sampling (default) writes sampled call stacks with little overhead, deterministic '
+                        'writes cProfile stats with exact call counts but runs much slower.')
+    p.add_argument('--profile_memory', action='store_true',
+                   help='With --profile, also write tracemalloc allocation hotspots to '
+                        '{PREFIX}.{stage}.alloc.tsv.')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to record the archive members and outputs of this run in '
+                        '(see query_catalog.py).')
+    p.add_argument('--read_buffer_mb', type=int, default=None,
+                   help='Read buffer size in MB (default 8).')
+    p.add_argument('--write_buffer_mb', type=int, default=None,
+                   help='Write buffer size in MB (default 8).')
+    p.add_argument('--compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of the outputs (default zlib\'s 6).')
+    p.add_argument('--intermediate_compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of intermediate outputs, i.e. streams '
+                                         'and --intermediate (default 1, 0 is uncompressed BGZF).')
+    p.add_argument('--intermediate', action='store_true',
+                   help='The vcf is an intermediate, e.g. re-read by remove_nonstandard_variants.py '
+                        'right away, and is compressed with --intermediate_compression_level.')
 
     args = p.parse_args()
 
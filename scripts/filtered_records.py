@@ -0,0 +1,68 @@
+"""
+Sidecar for records removed by the VCF filters.
+
+Rather than emitting one log line per removed record, removed records are
+written to a small bgzipped TSV next to the output. Only the first few are
+logged, followed by a per-reason summary when the sidecar is closed.
+"""
+from collections import OrderedDict
+
+from output_manifest import OutputFile
+
+# Reasons a record can be removed
+REF_EQUALS_ALT = 'ref_equals_alt'
+NONSTANDARD_ALLELE = 'nonstandard_allele'
+
+# Number of removed records logged individually before going quiet
+MAX_LOGGED = 10
+
+class FilteredRecordLog(object):
+    """
+    Writes removed records to a bgzipped TSV sidecar and keeps per-reason
+    counts, logging at most `max_logged` individual records.
+    """
+    columns = ['#CHROM', 'POS', 'REF', 'ALT', 'REASON']
+
+    def __init__(self, path, logger, max_logged=MAX_LOGGED):
+        self.path = path
+        self.logger = logger
+        self.max_logged = max_logged
+        self.counts = OrderedDict()
+        self.total = 0
+        self._writer = OutputFile(path)
+        self._writer.write(('\t'.join(self.columns) + '\n').encode('utf-8'))
+
+    def add(self, reason, chrom, pos, ref, alt):
+        """
+        Records a removed record. `alt` is the ALT column as written in the
+        VCF, i.e. comma separated for multi-allelic records.
+        """
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+        self.total += 1
+        self._writer.write_record(
+            '{0}\t{1}\t{2}\t{3}\t{4}\n'.format(chrom, pos, ref, alt, reason).encode('utf-8'))
+        if self.total <= self.max_logged:
+            self.logger.warning('Removing %s:%s:%s,%s (%s)', chrom, pos, ref, alt, reason)
+            if self.total == self.max_logged:
+                self.logger.warning('Further removed records are only written to %s', self.path)
+
+    def close(self):
+        """
+        Closes the sidecar and logs the per-reason summary.
+        """
+        self._writer.close()
+        summary = ', '.join('{0}={1}'.format(k, v) for k, v in self.counts.items())
+        self.logger.info('Removed %s records%s; see %s', self.total,
+                         ' ({0})'.format(summary) if summary else '', self.path)
+
+    def commit(self):
+        """
+        Moves the closed sidecar to its final path.
+        """
+        self._writer.commit()
+
+    def stats(self):
+        """
+        Returns the manifest entry for the sidecar.
+        """
+        return self._writer.stats()
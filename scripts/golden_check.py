@@ -0,0 +1,292 @@
+"""
+Golden output equivalence and performance regression gate.
+
+Runs a reference and a candidate copy of these scripts (e.g. a checkout of
+the last release and the working tree) on the same fixture archives and
+BAMs, and checks that every output of the reference is reproduced by the
+candidate. Some tasks run a different command in the candidate, comparing
+an alternative engine (e.g. the fused caveman filter) against the current
+implementation. Files are compared decompressed and tabix indices are compared
+by their contigs and the records fetched through them. Optionally fails if
+the candidate's throughput drops more than a threshold below a stored
+baseline.
+"""
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pysam
+
+# Outputs that legitimately differ between runs or engines
+IGNORED_SUFFIXES = ('stderr', '.manifest.json', '.state.json', '.partial')
+
+ASCAT_SEGMENTS = ['extract_ascat.py', 'reformat_copynumber', '-i', '{archive}',
+                  '-o', '{out}/segments.tsv', '-g', 'GOLDEN_ALIQUOT']
+
+# Tasks run on every fixture archive: (name, command template, candidate
+# command template or None to run the same command in both engines)
+ARCHIVE_TASKS = [
+    ('caveman', ['extract_caveman_vcf.py', '--results_archive', '{archive}',
+                 '--output_prefix', '{out}/caveman'], None),
+    ('pindel', ['extract_pindel_vcf.py', '--results_archive', '{archive}',
+                '--output_prefix', '{out}/pindel'], None),
+    ('brass_vcf', ['extract_brass_vcf.py', '--results_archive', '{archive}',
+                   '--output_prefix', '{out}/brass'], None),
+    ('brass_bedpe', ['extract_brass_bedpe.py', '--results_archive', '{archive}',
+                     '--output_prefix', '{out}/brass'], None),
+    ('ascat_segments', ASCAT_SEGMENTS, None),
+    ('ascat_stats', ['extract_ascat.py', 'extract_stats', '-i', '{archive}'], None),
+    # Runs on the reference engine's caveman output so both engines get the same input
+    ('nonstandard', ['remove_nonstandard_variants.py', '--input_vcf', '{caveman_vcf}',
+                     '--output_filename', '{out}/nonstandard.vcf.gz'], None),
+    # Alternative engines: the caveman extraction fused with the non-ACGT
+    # filter against the two-step pipeline, and the bgzipped segments
+    ('caveman_fused', ['remove_nonstandard_variants.py', '--input_vcf', '{caveman_vcf}',
+                       '--output_filename', '{out}/caveman.vcf.gz'],
+     ['extract_caveman_vcf.py', '--results_archive', '{archive}',
+      '--output_prefix', '{out}/caveman', '--remove_nonstandard_variants']),
+    ('ascat_segments_bgzip', ASCAT_SEGMENTS, ASCAT_SEGMENTS + ['--bgzip'])
+]
+
+# Tasks run on every fixture BAM
+BAM_TASKS = [
+    ('bam_header', ['check_bam_header.py', '--input_bam', '{bam}',
+                    '--aliquot_id', 'GOLDEN_ALIQUOT', '--output_header', '{out}/header.sam'], None)
+]
+
+def run_task(scripts_dir, command, out_dir, values):
+    """
+    Runs one task with the scripts in scripts_dir, writing its outputs,
+    stdout and stderr to out_dir. Returns (wall seconds, cpu seconds,
+    exit status).
+    """
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+    values = dict(values, out=out_dir)
+    cmd = [sys.executable, os.path.join(scripts_dir, command[0])] + \
+          [i.format(**values) for i in command[1:]]
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    with open(os.path.join(out_dir, 'stdout'), 'wb') as out, \
+            open(os.path.join(out_dir, 'stderr'), 'wb') as err:
+        status = subprocess.call(cmd, stdout=out, stderr=err)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    return wall, cpu, status
+
+def iter_file(path, chunk_size=1024 * 1024):
+    """
+    Yields the contents of a file in chunks, decompressed if it is gzipped.
+    """
+    with open(path, 'rb') as fh:
+        gzipped = fh.read(2) == b'\x1f\x8b'
+    opener = gzip.open if gzipped else open
+    with opener(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk: break
+            yield chunk
+
+def same_contents(path1, path2):
+    """
+    True if both files have the same (decompressed) contents.
+    """
+    buf1 = b''
+    buf2 = b''
+    it1 = iter_file(path1)
+    it2 = iter_file(path2)
+    while True:
+        if not buf1:
+            buf1 = next(it1, b'')
+        if not buf2:
+            buf2 = next(it2, b'')
+        if not buf1 or not buf2:
+            return not buf1 and not buf2
+        n = min(len(buf1), len(buf2))
+        if buf1[:n] != buf2[:n]:
+            return False
+        buf1 = buf1[n:]
+        buf2 = buf2[n:]
+
+def same_index(data1, data2):
+    """
+    True if the tabix indices of both data files have the same contigs and
+    return the same records for each of them. The raw index files differ
+    whenever the compressed layout of the data differs.
+    """
+    tbx1 = pysam.TabixFile(data1)
+    tbx2 = pysam.TabixFile(data2)
+    try:
+        if list(tbx1.contigs) != list(tbx2.contigs):
+            return False
+        for contig in tbx1.contigs:
+            for row1, row2 in itertools.zip_longest(tbx1.fetch(contig), tbx2.fetch(contig)):
+                if row1 != row2:
+                    return False
+        return True
+    finally:
+        tbx1.close()
+        tbx2.close()
+
+def compare_outputs(ref_dir, cand_dir):
+    """
+    Compares every output of the reference run with the candidate's.
+    Returns a list of mismatch descriptions. Extra candidate outputs
+    (e.g. sidecars the reference doesn't write) are allowed.
+    """
+    problems = []
+    for name in sorted(os.listdir(ref_dir)):
+        if name.endswith(IGNORED_SUFFIXES):
+            continue
+        ref = os.path.join(ref_dir, name)
+        cand = os.path.join(cand_dir, name)
+        if not os.path.exists(cand):
+            problems.append('{0}: missing'.format(name))
+        elif name.endswith('.tbi'):
+            if not same_index(ref[:-len('.tbi')], cand[:-len('.tbi')]):
+                problems.append('{0}: index contents differ'.format(name))
+        elif not same_contents(ref, cand):
+            problems.append('{0}: contents differ'.format(name))
+    return problems
+
+def run_engine(scripts_dir, command, out_dir, values, repeat):
+    """
+    Runs a task `repeat` times and returns the fastest (wall, cpu, status).
+    """
+    return min(run_task(scripts_dir, command, out_dir, values) for _ in range(repeat))
+
+def main(args):
+    """
+    Main wrapper for the golden output and performance checks.
+    """
+    workdir = tempfile.mkdtemp(prefix='golden_', dir=args.workdir)
+    failures = []
+    timings = {}
+    try:
+        jobs = []
+        for archive in args.archive or []:
+            for name, command, candidate in ARCHIVE_TASKS:
+                jobs.append((os.path.basename(archive), name, command, candidate, {'archive': archive}))
+        for bam in args.bam or []:
+            for name, command, candidate in BAM_TASKS:
+                jobs.append((os.path.basename(bam), name, command, candidate, {'bam': bam}))
+
+        for fixture, name, command, candidate, values in jobs:
+            key = '{0}:{1}'.format(fixture, name)
+            ref_dir = os.path.join(workdir, fixture, name, 'reference')
+            cand_dir = os.path.join(workdir, fixture, name, 'candidate')
+            values = dict(values, caveman_vcf=os.path.join(workdir, fixture, 'caveman',
+                                                            'reference', 'caveman.vcf.gz'))
+            ref_time = run_engine(args.reference_scripts, command, ref_dir, values, args.repeat)
+            cand_time = run_engine(args.candidate_scripts, candidate or command, cand_dir, values,
+                                   args.repeat)
+            timings[key] = {'seconds': cand_time[0], 'cpu_seconds': cand_time[1],
+                            'reference_seconds': ref_time[0],
+                            'reference_cpu_seconds': ref_time[1]}
+            logger.info("{0}: reference {1:.3f}s ({2:.3f}s cpu), candidate {3:.3f}s ({4:.3f}s cpu)".format(
+                key, ref_time[0], ref_time[1], cand_time[0], cand_time[1]))
+
+            # A task failing in both engines (e.g. a missing member) is a match
+            if ref_time[2] != cand_time[2]:
+                problems = ['exit status {0}, reference {1}'.format(cand_time[2], ref_time[2])]
+            elif ref_time[2] != 0:
+                problems = []
+            else:
+                problems = compare_outputs(ref_dir, cand_dir)
+            for problem in problems:
+                failures.append('{0}: {1}'.format(key, problem))
+                logger.error("{0}: {1}".format(key, problem))
+
+        if args.baseline and os.path.exists(args.baseline) and not args.update_baseline:
+            with open(args.baseline, 'r') as fh:
+                baseline = json.load(fh)
+            for key, timing in sorted(timings.items()):
+                if key not in baseline:
+                    continue
+                # throughput drop > threshold <=> time > baseline / (1 - threshold)
+                limit = baseline[key]['seconds'] / (1.0 - args.threshold)
+                if timing['seconds'] > limit:
+                    failures.append('{0}: throughput regression'.format(key))
+                    logger.error("{0}: took {1:.3f}s, baseline {2:.3f}s (limit {3:.3f}s)".format(
+                        key, timing['seconds'], baseline[key]['seconds'], limit))
+
+        if args.update_baseline:
+            logger.info("Writing baseline {0}".format(args.baseline))
+            with open(args.baseline, 'w') as o:
+                json.dump(timings, o, indent=2, sort_keys=True)
+                o.write('\n')
+    finally:
+        if args.keep:
+            logger.info("Keeping outputs in {0}".format(workdir))
+        else:
+            shutil.rmtree(workdir)
+
+    if failures:
+        logger.error("{0} checks failed.".format(len(failures)))
+        return 1
+    logger.info("All {0} tasks match the reference.".format(len(timings)))
+    return 0
+
+def setup_logger():
+    """
+    Sets up the logger.
+    """
+    logger = logging.getLogger("golden_check")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+if __name__ == '__main__':
+    """
+    CLI Entrypoint.
+    """
+    start = time.time()
+    logger = setup_logger()
+    logger.info("-"*80)
+    logger.info("golden_check.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    p = argparse.ArgumentParser('Golden output equivalence and performance regression gate.')
+    p.add_argument('--reference_scripts', required=True,
+                   help='Scripts directory of the reference implementation.')
+    p.add_argument('--candidate_scripts', default=os.path.dirname(os.path.abspath(__file__)),
+                   help='Scripts directory of the candidate implementation (default this one).')
+    p.add_argument('--archive', action='append', help='Fixture results archive, can be given multiple times.')
+    p.add_argument('--bam', action='append', help='Fixture bam, can be given multiple times.')
+    p.add_argument('--baseline', default=None, help='Json file with the stored candidate timings.')
+    p.add_argument('--update_baseline', action='store_true',
+                   help='Write the candidate timings to --baseline instead of checking them.')
+    p.add_argument('--threshold', type=float, default=0.1,
+                   help='Maximum allowed throughput drop against the baseline (default 0.1).')
+    p.add_argument('--repeat', type=int, default=1,
+                   help='Runs per task and engine; the fastest is used (default 1).')
+    p.add_argument('--workdir', default=None, help='Directory for the task outputs (default tmp).')
+    p.add_argument('--keep', action='store_true', help='Keep the task outputs.')
+
+    args = p.parse_args()
+    if not args.archive and not args.bam:
+        p.error('At least one --archive or --bam is required')
+    if args.update_baseline and not args.baseline:
+        p.error('--update_baseline requires --baseline')
+
+    status = main(args)
+
+    # Done
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
+    sys.exit(status)
@@ -0,0 +1,248 @@
+"""
+Output writers that compute checksums, byte sizes and data record counts
+while the file is being written, plus the sidecar manifest they feed.
+
+The GDC metadata for every output needs its md5sum, file size and record
+count. Tracking them here means the outputs never have to be re-read.
+"""
+import hashlib
+import json
+import os
+import stat
+import struct
+import zlib
+
+import pysam
+
+from buffered_io import get_config, open_stdout, open_write
+from compression import FINAL, INTERMEDIATE, get_level
+
+# Output path meaning stdout
+STDOUT = '-'
+
+# Suffix of outputs that are still being written
+PARTIAL_SUFFIX = '.partial'
+
+# Maximum uncompressed payload of a single BGZF block (same as htslib).
+BGZF_BLOCK_SIZE = 0xff00
+
+# The empty BGZF block htslib writes to mark the end of the file.
+BGZF_EOF = (b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'
+            b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+def bgzf_block(data, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Compresses up to BGZF_BLOCK_SIZE bytes into a single BGZF block.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(cdata) + 25)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+def is_stream(path):
+    """
+    True if the output path is stdout or a named pipe. Streams can't be
+    tabix indexed, the consumer has to index them if needed.
+    """
+    if path == STDOUT:
+        return True
+    return os.path.exists(path) and stat.S_ISFIFO(os.stat(path).st_mode)
+
+class HashingWriter(object):
+    """
+    Binary file wrapper tracking the md5, sha256 and size of all bytes written.
+    Writes are coalesced into chunks of `buffer_size` bytes, so the hashes
+    are updated and the file is written in few large calls. Writes of at
+    least `buffer_size` bytes are passed through without a copy.
+    """
+    def __init__(self, fh, close_fh=True, buffer_size=None):
+        self.fh = fh
+        self.close_fh = close_fh
+        self.buffer_size = buffer_size or get_config()['write_buffer_size']
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self._pending = bytearray()
+
+    def write(self, data):
+        self.size += len(data)
+        if len(data) >= self.buffer_size:
+            self._drain()
+            self._write(data)
+            return
+        self._pending.extend(data)
+        if len(self._pending) >= self.buffer_size:
+            self._drain()
+
+    def _write(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.fh.write(data)
+
+    def _drain(self):
+        if not self._pending:
+            return
+        with memoryview(self._pending) as view:
+            self._write(view)
+        del self._pending[:]
+
+    def close(self):
+        self._drain()
+        if self.close_fh:
+            self.fh.close()
+        else:
+            self.fh.flush()
+
+class BgzfWriter(object):
+    """
+    Minimal BGZF writer on top of a binary file object. The output is
+    readable by htslib and can be tabix indexed like pysam.BGZFile output.
+    Data is buffered up to `buffer_size` bytes and all complete blocks are
+    then compressed and written in one call.
+    """
+    def __init__(self, fh, level=zlib.Z_DEFAULT_COMPRESSION, buffer_size=None):
+        self.fh = fh
+        self.level = level
+        self.buffer_size = max(buffer_size or get_config()['write_buffer_size'], BGZF_BLOCK_SIZE)
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer.extend(data)
+        if len(self._buffer) >= self.buffer_size:
+            self._flush_blocks(complete_only=True)
+
+    def _flush_blocks(self, complete_only=False):
+        start = 0
+        end = len(self._buffer)
+        blocks = []
+        while end - start >= BGZF_BLOCK_SIZE or (not complete_only and end > start):
+            chunk = bytes(self._buffer[start:start + BGZF_BLOCK_SIZE])
+            blocks.append(bgzf_block(chunk, self.level))
+            start += len(chunk)
+        if blocks:
+            self.fh.write(b''.join(blocks))
+        del self._buffer[:start]
+
+    def close(self):
+        """
+        Flushes any buffered data and writes the EOF marker. The underlying
+        file object is left open.
+        """
+        self._flush_blocks()
+        self.fh.write(BGZF_EOF)
+
+class OutputFile(object):
+    """
+    Writes an output file, BGZF compressed or plain, while tracking its
+    checksums, byte size and number of data records. The path can also be
+    a named pipe or STDOUT.
+
+    Regular files are written to {path}.partial and only renamed to the
+    final path by commit(), so an interrupted run never leaves a truncated
+    file under the final name.
+
+    Unless `level` is given, the compression level comes from the policy in
+    compression.py: the intermediate level for outputs flagged
+    `intermediate` and for streams, which are consumed right away, and the
+    final level otherwise.
+    """
+    def __init__(self, path, compress=True, level=None, intermediate=False):
+        self.path = path
+        if level is None:
+            level = get_level(INTERMEDIATE if intermediate or is_stream(path) else FINAL)
+        self.level = level
+        self.records = 0
+        if path == STDOUT:
+            self.tmp_path = path
+            self._sink = HashingWriter(open_stdout(), close_fh=False)
+        else:
+            self.tmp_path = path if is_stream(path) else path + PARTIAL_SUFFIX
+            self._sink = HashingWriter(open_write(self.tmp_path))
+        self._writer = BgzfWriter(self._sink, level) if compress else None
+
+    def write(self, data):
+        """
+        Writes header or other non-record bytes.
+        """
+        if self._writer is not None:
+            self._writer.write(data)
+        else:
+            self._sink.write(data)
+
+    def write_record(self, data):
+        """
+        Writes a single data record.
+        """
+        self.records += 1
+        self.write(data)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._sink.close()
+
+    def commit(self):
+        """
+        Moves the closed output to its final path.
+        """
+        if self.tmp_path != self.path:
+            os.replace(self.tmp_path, self.path)
+
+    def stats(self):
+        """
+        Returns the manifest entry for this output.
+        """
+        return {
+            'file_name': os.path.basename(self.path),
+            'file_size': self._sink.size,
+            'md5sum': self._sink.md5.hexdigest(),
+            'sha256': self._sink.sha256.hexdigest(),
+            'record_count': self.records
+        }
+
+def file_stats(path):
+    """
+    Returns the manifest entry for a file written by another tool (e.g. a
+    tabix index). Only meant for small files since it reads the whole file.
+    """
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(1024 * 1024)
+            if not chunk: break
+            md5.update(chunk)
+            sha256.update(chunk)
+    return {
+        'file_name': os.path.basename(path),
+        'file_size': os.path.getsize(path),
+        'md5sum': md5.hexdigest(),
+        'sha256': sha256.hexdigest(),
+        'record_count': None
+    }
+
+def index_output(path, **kwargs):
+    """
+    Tabix indexes an output, writing the index under a temporary name first
+    so a partial index never shows up as {path}.tbi. The keyword arguments
+    are passed to pysam.tabix_index. Returns the manifest entry of the index.
+    """
+    index = path + '.tbi'
+    pysam.tabix_index(path, force=True, index=index + PARTIAL_SUFFIX, **kwargs)
+    os.replace(index + PARTIAL_SUFFIX, index)
+    return file_stats(index)
+
+def write_manifest(path, entries, filter_counts=None):
+    """
+    Writes the sidecar manifest json with one entry per output file and,
+    for filtering steps, the number of removed records per reason.
+    """
+    manifest = {'files': entries}
+    if filter_counts is not None:
+        manifest['filter_counts'] = filter_counts
+    with open(path + PARTIAL_SUFFIX, 'w') as o:
+        json.dump(manifest, o, indent=2, sort_keys=True)
+        o.write('\n')
+    os.replace(path + PARTIAL_SUFFIX, path)
@@ -0,0 +1,155 @@
+"""
+Per-stage profiling for the --profile mode of the scripts.
+
+Each named stage (e.g. transformed, indexed) is profiled separately and
+writes, under the given prefix:
+
+* {prefix}.{stage}.collapsed - in the default sampling mode, sampled call
+  stacks in the collapsed format of flamegraph.pl / speedscope, one
+  "frame;frame;... count" line per stack. The sampler adds little overhead.
+* {prefix}.{stage}.pstats - in the deterministic mode, cProfile stats for
+  pstats/snakeviz, with exact call counts at the cost of a much slower run
+* {prefix}.{stage}.alloc.tsv - optionally, the top tracemalloc allocation
+  sites by line, with the bytes still allocated at the end of the stage,
+  and the peak traced memory of the stage
+"""
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import cProfile
+import os
+import signal
+import time
+import tracemalloc
+
+# Profiling modes
+SAMPLING = 'sampling'
+DETERMINISTIC = 'deterministic'
+MODES = [SAMPLING, DETERMINISTIC]
+
+# Seconds of cpu time between stack samples
+SAMPLE_INTERVAL = 0.005
+
+# Number of allocation sites written per stage
+TOP_ALLOCATIONS = 50
+
+class StackSampler(object):
+    """
+    Samples the python call stack of the main thread on a cpu time timer.
+    Time spent in C code (zlib, htslib) is attributed to the python frame
+    that called it.
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self._handler = None
+
+    def _sample(self, signum, frame):
+        """
+        SIGPROF handler, records the interrupted stack.
+        """
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{0} ({1}:{2})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                code.co_firstlineno))
+            frame = frame.f_back
+        self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        """
+        Starts sampling.
+        """
+        self._handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """
+        Stops sampling and restores the previous SIGPROF handler.
+        """
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._handler)
+
+    def write(self, path):
+        """
+        Writes the samples as collapsed stacks.
+        """
+        with open(path, 'w') as o:
+            for stack, count in sorted(self.counts.items()):
+                o.write('{0} {1}\n'.format(stack, count))
+
+def write_allocations(snapshot, peak, path, top=TOP_ALLOCATIONS):
+    """
+    Writes the largest allocation sites of a tracemalloc snapshot as a TSV,
+    leaving out those of the profilers themselves.
+    """
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, i)
+                                       for i in (tracemalloc.__file__, cProfile.__file__, __file__)])
+    with open(path, 'w') as o:
+        o.write('##peak_traced_bytes={0}\n'.format(peak))
+        o.write('#size_bytes\tcount\tlocation\n')
+        for stat in snapshot.statistics('lineno')[:top]:
+            frame = stat.traceback[0]
+            o.write('{0}\t{1}\t{2}:{3}\n'.format(stat.size, stat.count, frame.filename, frame.lineno))
+
+class Profiler(object):
+    """
+    Profiles named stages with the stack sampler or, in the deterministic
+    `mode`, with cProfile, writing the outputs under `prefix`. With prefix
+    None stages are only timed. The wall time of each stage is always
+    recorded in `timings`.
+
+    `memory` also records tracemalloc allocation sites, which slows the run
+    down considerably. Stages opened inside another stage are folded into
+    the outer one.
+    """
+    def __init__(self, prefix=None, mode=SAMPLING, memory=False, interval=SAMPLE_INTERVAL):
+        if mode not in MODES:
+            raise ValueError("Invalid profiling mode {0}".format(mode))
+        self.prefix = prefix
+        self.mode = mode
+        self.memory = memory
+        self.interval = interval
+        self.timings = OrderedDict()
+        self._active = False
+        if prefix and os.path.dirname(prefix):
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profiles the enclosed block as stage `name`.
+        """
+        if self._active:
+            yield
+            return
+        if not self.prefix:
+            start = time.time()
+            yield
+            self.timings[name] = time.time() - start
+            return
+
+        self._active = True
+        start = time.time()
+        # Never both; cProfile's instrumentation would skew the samples
+        if self.mode == DETERMINISTIC:
+            profile = cProfile.Profile()
+            enable, disable, write, suffix = profile.enable, profile.disable, profile.dump_stats, '.pstats'
+        else:
+            sampler = StackSampler(self.interval)
+            enable, disable, write, suffix = sampler.start, sampler.stop, sampler.write, '.collapsed'
+        trace_memory = self.memory and not tracemalloc.is_tracing()
+        if trace_memory:
+            tracemalloc.start()
+        enable()
+        try:
+            yield
+        finally:
+            disable()
+            self.timings[name] = time.time() - start
+            self._active = False
+            path = '{0}.{1}'.format(self.prefix, name)
+            write(path + suffix)
+            if trace_memory:
+                write_allocations(tracemalloc.take_snapshot(), tracemalloc.get_traced_memory()[1],
+                                  path + '.alloc.tsv')
+                tracemalloc.stop()
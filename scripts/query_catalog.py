@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Queries the SQLite catalog written by the extraction scripts with --catalog,
+e.g. to find the archives with a pindel VCF over 1 GB or the samples that
+had ref == alt caveman loci removed, without reopening any archive.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+from catalog import connect_read_only
+from profiling import MODES, SAMPLING, Profiler
+
+# Multipliers of the size suffixes accepted by --min_size and --max_size
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(size):
+    """
+    Parse a size with an optional K, M, G or T suffix.
+    @param size: e.g. 500, 64K or 1.5G
+    @return size in bytes
+    """
+    size = size.strip().upper().rstrip('B')
+    unit = size[-1:] if size[-1:] in SIZE_UNITS else ''
+    return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+
+def build_query(select, conditions, group_by=None, order_by=None):
+    """
+    Build a query from a select clause and (sql, parameter) conditions,
+    skipping conditions whose parameter is None.
+    @return (sql, parameters) tuple
+    """
+    where = [(sql, param) for sql, param in conditions if param is not None]
+    sql = select
+    if where:
+        sql += ' WHERE ' + ' AND '.join(i[0] for i in where)
+    if group_by:
+        sql += ' GROUP BY ' + group_by
+    if order_by:
+        sql += ' ORDER BY ' + order_by
+    return sql, [i[1] for i in where]
+
+def query_members(args):
+    """
+    Archive members matching a name glob and size range.
+    """
+    return build_query(
+        'SELECT a.path AS archive, m.name, m.offset, m.size '
+        'FROM members m JOIN archives a ON a.id = m.archive_id',
+        [('m.name GLOB ?', args.name),
+         ('a.path GLOB ?', args.archive),
+         ('m.size >= ?', parse_size(args.min_size) if args.min_size else None),
+         ('m.size <= ?', parse_size(args.max_size) if args.max_size else None)],
+        order_by='a.path, m.offset')
+
+def query_filters(args):
+    """
+    Runs that removed records, with the per-reason counts.
+    """
+    return build_query(
+        'SELECT r.input, r.caller, r.output_prefix, f.reason, f.count '
+        'FROM filter_counts f JOIN runs r ON r.id = f.run_id',
+        [('f.reason = ?', args.reason),
+         ('r.caller = ?', args.caller),
+         ('r.input GLOB ?', args.input),
+         ('f.count >= ?', args.min_count)],
+        order_by='r.input, r.caller, f.reason')
+
+def query_outputs(args):
+    """
+    Outputs of finished runs with their checksums and record counts.
+    """
+    return build_query(
+        'SELECT r.input, r.caller, o.file_name, o.file_size, o.md5sum, o.sha256, o.record_count '
+        'FROM outputs o JOIN runs r ON r.id = o.run_id',
+        [('r.caller = ?', args.caller),
+         ('r.input GLOB ?', args.input),
+         ('o.file_name GLOB ?', args.name)],
+        order_by='r.input, r.caller, o.file_name')
+
+def query_timings(args):
+    """
+    Stage timings aggregated per caller and stage.
+    """
+    return build_query(
+        'SELECT r.caller, t.stage, COUNT(*) AS runs, SUM(t.seconds) AS total_seconds, '
+        'MAX(t.seconds) AS max_seconds '
+        'FROM stage_timings t JOIN runs r ON r.id = t.run_id',
+        [('r.caller = ?', args.caller),
+         ('t.stage = ?', args.stage)],
+        group_by='r.caller, t.stage', order_by='r.caller, t.stage')
+
+def query_sql(args):
+    """
+    An arbitrary query.
+    """
+    return args.query, []
+
+def run(args):
+    """
+    Run the query and write the result as a TSV with a header line.
+    """
+    sql, params = args.func(args)
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
+    conn = connect_read_only(args.catalog)
+    o = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with profiler.stage('query'):
+            cursor = conn.execute(sql, params)
+            o.write('\t'.join(i[0] for i in cursor.description) + '\n')
+            n = 0
+            for row in cursor:
+                o.write('\t'.join('' if i is None else str(i) for i in row) + '\n')
+                n += 1
+    finally:
+        conn.close()
+        if o is not sys.stdout:
+            o.close()
+    logger.info("Found {0} rows.".format(n))
+
+def setup_logger():
+    """
+    Sets up the logger.
+    @return logger
+    """
+    logger = logging.getLogger("query_catalog")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+def main():
+    """
+    Main wrapper for the program.
+    """
+    start = time.time()
+    logger.info("-"*80)
+    logger.info("query_catalog.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    description = 'Query the SQLite catalog of archive members and outputs written with --catalog.'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--catalog', '-c', required=True, help='path to the SQLite catalog')
+    parser.add_argument('--output', '-o', help='path for output TSV, defaults to stdout')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='profile the query, writing {PREFIX}.query.collapsed (or .pstats) files')
+    parser.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                        help='sampled call stacks (default) or slower, exact cProfile stats')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='with --profile, also write allocation hotspots to {PREFIX}.query.alloc.tsv')
+    subparsers = parser.add_subparsers()
+
+    members = subparsers.add_parser('members', help='archive members')
+    members.add_argument('--name', help='member name glob, e.g. "*/pindel/*.vcf.gz"')
+    members.add_argument('--archive', help='archive path glob')
+    members.add_argument('--min_size', help='minimum member size, e.g. 1G')
+    members.add_argument('--max_size', help='maximum member size, e.g. 500M')
+    members.set_defaults(func=query_members)
+
+    filters = subparsers.add_parser('filters', help='records removed by the filters')
+    filters.add_argument('--reason', help='e.g. ref_equals_alt or nonstandard_allele')
+    filters.add_argument('--caller', help='e.g. caveman or remove_nonstandard_variants')
+    filters.add_argument('--input', help='input path glob')
+    filters.add_argument('--min_count', type=int, default=1, help='minimum removed records (default 1)')
+    filters.set_defaults(func=query_filters)
+
+    outputs = subparsers.add_parser('outputs', help='outputs with checksums and record counts')
+    outputs.add_argument('--caller', help='e.g. caveman, pindel, brass_vcf, brass_bedpe, ascat_copynumber')
+    outputs.add_argument('--input', help='input path glob')
+    outputs.add_argument('--name', help='output file name glob')
+    outputs.set_defaults(func=query_outputs)
+
+    timings = subparsers.add_parser('timings', help='stage timings per caller')
+    timings.add_argument('--caller', help='e.g. caveman')
+    timings.add_argument('--stage', help='e.g. transformed')
+    timings.set_defaults(func=query_timings)
+
+    sql = subparsers.add_parser('sql', help='arbitrary SQL query')
+    sql.add_argument('query', help='SQL query')
+    sql.set_defaults(func=query_sql)
+
+    args = parser.parse_args()
+    if not hasattr(args, 'func'):
+        parser.error('A query command is required')
+    if not os.path.isfile(args.catalog):
+        parser.error('Catalog {0} does not exist'.format(args.catalog))
+    run(args)
+
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
+
+if __name__ == '__main__':
+    logger = setup_logger()
+    main()
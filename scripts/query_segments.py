@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+Point and interval lookups over GDC copy number segment files written by
+`extract_ascat.py reformat_copynumber --bgzip`.
+
+Each segment file is opened once and all regions are fetched through its
+tabix index, so batches of regions over many samples don't scan any file.
+"""
+
+import argparse
+import logging
+import pysam
+import sys
+import time
+
+from profiling import MODES, SAMPLING, Profiler
+
+SEG_HEADER = ["GDC_Aliquot", "Chromosome", "Start", "End", "Copy_Number",
+              "Major_Copy_Number", "Minor_Copy_Number"]
+
+def parse_region(region):
+    """
+    Parse a region string.
+    @param region: chrom:pos for a point or chrom:start-end for an interval, 1-based inclusive
+    @return (chrom, start, end) tuple, 1-based inclusive
+    """
+    chrom, _, pos = region.strip().rpartition(':')
+    if not chrom:
+        raise ValueError("Region must be chrom:pos or chrom:start-end - {0}".format(region))
+    start, _, end = pos.replace(',', '').partition('-')
+    start = int(start)
+    end = int(end) if end else start
+    if end < start:
+        raise ValueError("Region end is before start - {0}".format(region))
+    return (chrom, start, end)
+
+def read_list(path):
+    """
+    Read a file with one item per line, skipping blank lines.
+    @param path: path to the file
+    @return list of items
+    """
+    with open(path, 'r') as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+def query_segments(seg_files, regions):
+    """
+    Find the segments overlapping each region in each segment file.
+    @param seg_files: paths to bgzipped, tabix indexed segment files
+    @param regions: (chrom, start, end) tuples, 1-based inclusive
+    @return generator of (region, segment columns) tuples
+    """
+    regions = sorted(set(regions))
+    for seg_file in seg_files:
+        tbx = pysam.TabixFile(seg_file)
+        try:
+            contigs = set(tbx.contigs)
+            for region in regions:
+                chrom, start, end = region
+                if chrom not in contigs:
+                    continue
+                for row in tbx.fetch(chrom, start - 1, end):
+                    yield region, row.split('\t')
+        finally:
+            tbx.close()
+
+def format_region(region):
+    """
+    Format a region tuple as chrom:start-end.
+    """
+    return '{0}:{1}-{2}'.format(*region)
+
+def run(args):
+    """
+    Run the queries and write the matching segments as a TSV.
+    """
+    seg_files = list(args.segment_file or [])
+    if args.segment_files_list:
+        seg_files.extend(read_list(args.segment_files_list))
+    region_strs = list(args.region or [])
+    if args.regions_file:
+        region_strs.extend(read_list(args.regions_file))
+    regions = [parse_region(i) for i in region_strs]
+    if not seg_files or not regions:
+        raise ValueError("At least one segment file and one region are required")
+
+    logger.info("Querying {0} regions in {1} segment files...".format(len(regions), len(seg_files)))
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
+    o = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        with profiler.stage('query'):
+            o.write('\t'.join(["Query"] + SEG_HEADER) + '\n')
+            n = 0
+            for region, row in query_segments(seg_files, regions):
+                o.write('\t'.join([format_region(region)] + row) + '\n')
+                n += 1
+    finally:
+        if o is not sys.stdout:
+            o.close()
+    logger.info("Found {0} overlapping segments.".format(n))
+
+def setup_logger():
+    """
+    Sets up the logger.
+    @return logger
+    """
+    logger = logging.getLogger("query_segments")
+    LoggerFormat = '[%(levelname)s] [%(asctime)s] [%(name)s] - %(message)s'
+    logger.setLevel(level=logging.INFO)
+    handler = logging.StreamHandler(sys.stderr)
+    formatter = logging.Formatter(LoggerFormat, datefmt='%Y%m%d %H:%M:%S')
+    handler.setFormatter(formatter)
+    logger.addHandler(handler)
+    return logger
+
+def main():
+    """
+    Main wrapper for the program.
+    """
+    start = time.time()
+    logger.info("-"*80)
+    logger.info("query_segments.py")
+    logger.info("Program Args: {0}".format(" ".join(sys.argv)))
+    logger.info("-"*80)
+
+    description = 'Point and interval lookups over bgzipped, tabix indexed GDC copy number segment files.'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--segment_file', '-s', action='append',
+                        help='segment file to query, can be given multiple times')
+    parser.add_argument('--segment_files_list', '-S',
+                        help='file with one segment file path per line')
+    parser.add_argument('--region', '-r', action='append',
+                        help='chrom:pos or chrom:start-end (1-based, inclusive), can be given multiple times')
+    parser.add_argument('--regions_file', '-R',
+                        help='file with one region per line')
+    parser.add_argument('--output', '-o', help='path for output TSV, defaults to stdout')
+    parser.add_argument('--profile', metavar='PREFIX',
+                        help='profile the queries, writing {PREFIX}.query.collapsed (or .pstats) files')
+    parser.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                        help='sampled call stacks (default) or slower, exact cProfile stats')
+    parser.add_argument('--profile_memory', action='store_true',
+                        help='with --profile, also write allocation hotspots to {PREFIX}.query.alloc.tsv')
+    args = parser.parse_args()
+
+    run(args)
+
+    logger.info("Finished, took {0} seconds.".format(time.time() - start))
+
+if __name__ == '__main__':
+    logger = setup_logger()
+    main()
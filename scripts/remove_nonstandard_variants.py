@@ -10,38 +10,71 @@ import argparse
 import logging
 import pysam
 
+from buffered_io import configure_from_args
+from catalog import Catalog
+from compression import configure_levels_from_args
+from filtered_records import FilteredRecordLog, NONSTANDARD_ALLELE
+from output_manifest import OutputFile, STDOUT, index_output, is_stream, write_manifest
+from profiling import MODES, SAMPLING, Profiler
+
 def main(args, logger):
     """
     Main wrapper script for removing non-standard variants
     """
+    configure_from_args(args)
+    configure_levels_from_args(args)
+
     # Allowed
     good = set(['A', 'T', 'C', 'G'])
+    profiler = Profiler(args.profile, mode=args.profile_mode, memory=args.profile_memory)
 
-    # Reader
+    # Reader; streams can't seek so they are iterated instead of fetched
     reader = pysam.VariantFile(args.input_vcf)
+    records = reader if is_stream(args.input_vcf) else reader.fetch()
 
     # Writer
-    mode = 'wz' if args.output_filename.endswith('gz') else 'w'
-    writer = pysam.VariantFile(args.output_filename, mode=mode, header=reader.header)
+    if args.output_format == 'auto':
+        mode = 'wz' if args.output_filename.endswith('gz') else 'w'
+    else:
+        mode = 'wz' if args.output_format == 'bgzf' else 'w'
+    index = mode == 'wz' and not args.skip_index and not is_stream(args.output_filename)
+    sidecar_prefix = args.sidecar_prefix or args.output_filename
+    writer = OutputFile(args.output_filename, compress=mode == 'wz')
+    writer.write(str(reader.header).encode('utf-8'))
+    filtered = FilteredRecordLog('{0}.filtered.tsv.gz'.format(sidecar_prefix), logger)
 
     # Process
     try:
-        for record in reader.fetch():
-            alleles = list(record.alleles)
-            alleles_set = set(list(''.join(alleles).upper()))
-            check = alleles_set - good
-            if check:
-                logger.warning('Removing %s:%s:%s', record.chrom, record.pos, ','.join(alleles))
-                continue
-            else:
-                writer.write(record)
+        with profiler.stage('transformed'):
+            for record in records:
+                alleles = list(record.alleles)
+                alleles_set = set(list(''.join(alleles).upper()))
+                check = alleles_set - good
+                if check:
+                    # '.' for no ALT, as the VCF (and the fused caveman filter) has it
+                    filtered.add(NONSTANDARD_ALLELE, record.chrom, record.pos, alleles[0],
+                                 ','.join(alleles[1:]) or '.')
+                    continue
+                else:
+                    writer.write_record(str(record).encode('utf-8'))
 
     finally:
         reader.close()
         writer.close()
+        filtered.close()
+    writer.commit()
+    filtered.commit()
 
-    if mode == 'wz':
-        pysam.tabix_index(args.output_filename, preset='vcf', force=True)
+    manifest = [writer.stats()]
+    if index:
+        with profiler.stage('indexed'):
+            manifest.append(index_output(args.output_filename, preset='vcf'))
+    manifest.append(filtered.stats())
+    write_manifest('{0}.manifest.json'.format(sidecar_prefix), manifest,
+                   filter_counts=filtered.counts)
+    Catalog(args.catalog).record_run('remove_nonstandard_variants', args.input_vcf, manifest,
+                                     output_prefix=sidecar_prefix, filter_counts=filtered.counts,
+                                     timings=profiler.timings)
 
 
 def setup_logger():
@@ -69,10 +102,40 @@ if __name__ == '__main__':
     logger_.info("-"*80)
 
     p = argparse.ArgumentParser('Utility for hard filtering non-standard variants.')
-    p.add_argument('--input_vcf', required=True, help='Input VCF file.')
-    p.add_argument('--output_filename', required=True, help='File basename for output VCF file.')
+    p.add_argument('--input_vcf', required=True, help='Input VCF file, named pipe or - for stdin.')
+    p.add_argument('--output_filename', required=True,
+                   help='File basename for output VCF file, named pipe or - for stdout.')
+    p.add_argument('--output_format', choices=['auto', 'bgzf', 'vcf'], default='auto',
+                   help='Output compression. auto (default) bgzips if the output filename ends with gz.')
+    p.add_argument('--skip_index', action='store_true',
+                   help='Do not tabix index the output, e.g. to index it later. Implied for '
+                        'uncompressed output, named pipes and stdout.')
+    p.add_argument('--sidecar_prefix', default=None,
+                   help='Prefix for the manifest and filtered record sidecars. Defaults to '
+                        '--output_filename; required when writing to stdout.')
+    p.add_argument('--profile', default=None, metavar='PREFIX',
+                   help='Profile each stage, writing {PREFIX}.{stage}.collapsed (or .pstats) files.')
+    p.add_argument('--profile_mode', choices=MODES, default=SAMPLING,
+                   help='sampling (default) writes sampled call stacks with little overhead, deterministic '
+                        'writes cProfile stats with exact call counts but runs much slower.')
+    p.add_argument('--profile_memory', action='store_true',
+                   help='With --profile, also write tracemalloc allocation hotspots to '
+                        '{PREFIX}.{stage}.alloc.tsv.')
+    p.add_argument('--catalog', default=None,
+                   help='SQLite catalog to record the outputs of this run in (see query_catalog.py).')
+    p.add_argument('--read_buffer_mb', type=int, default=None,
+                   help='Read buffer size in MB (default 8).')
+    p.add_argument('--write_buffer_mb', type=int, default=None,
+                   help='Write buffer size in MB (default 8).')
+    p.add_argument('--compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of the outputs (default zlib\'s 6).')
+    p.add_argument('--intermediate_compression_level', type=int, default=None, choices=range(-1, 10),
+                   metavar='{0-9}', help='BGZF compression level of intermediate outputs, i.e. named '
+                                         'pipes and stdout (default 1, 0 is uncompressed BGZF).')
 
     args_ = p.parse_args()
+    if args_.output_filename == STDOUT and not args_.sidecar_prefix:
+        p.error('--sidecar_prefix is required when writing to stdout')
 
     # Process
     logger_.info("Processing input VCF file %s...", args_.input_vcf)
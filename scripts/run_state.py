@@ -0,0 +1,109 @@
+"""
+Checkpointed progress for resumable runs.
+
+A run records each finished stage (e.g. extracted, transformed, indexed)
+with the manifest entries of the files it produced in a json state file.
+When a pre-empted job is restarted with the same inputs, stages whose
+recorded outputs are still present and match their checksums are skipped.
+"""
+import json
+import os
+
+from output_manifest import PARTIAL_SUFFIX, file_stats
+
+# Stages of the extraction scripts, in order
+STAGES = ['extracted', 'transformed', 'indexed']
+
+class RunState(object):
+    """
+    Stage checkpoints of one run, persisted to `path`. With path None the
+    state is only kept in memory.
+
+    `inputs` describes what the run is computed from (archive, member keys,
+    options). Checkpoints recorded for different inputs are ignored.
+    `order` lists the stages in the order they run.
+    """
+    def __init__(self, path=None, inputs=None, order=STAGES):
+        self.path = path
+        self.inputs = inputs or {}
+        self.order = list(order)
+        self.stages = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as fh:
+                state = json.load(fh)
+            if state.get('inputs') == self.inputs:
+                self.stages = state.get('stages', {})
+
+    def is_done(self, stage):
+        """
+        True if the stage was completed and all of its outputs are still
+        valid, i.e. present with the recorded size and md5. Otherwise the
+        stage and all later stages are dropped since they will be redone.
+        """
+        if self._is_valid(self.stages.get(stage)):
+            return True
+        for later in self.order[self.order.index(stage):]:
+            self.stages.pop(later, None)
+        return False
+
+    def _is_valid(self, record):
+        if record is None:
+            return False
+        for entry in record['files']:
+            path = entry['path']
+            if not os.path.exists(path) or os.path.getsize(path) != entry['file_size']:
+                return False
+            if file_stats(path)['md5sum'] != entry['md5sum']:
+                return False
+        return True
+
+    def mark_done(self, stage, files, **extra):
+        """
+        Records a finished stage. `files` are (path, manifest entry) pairs of
+        its outputs; extra keyword arguments are stored with the stage.
+        """
+        record = dict(extra)
+        record['files'] = []
+        for path, entry in files:
+            entry = dict(entry)
+            entry['path'] = path
+            record['files'].append(entry)
+        self.stages[stage] = record
+        self._save()
+
+    def get(self, stage, key):
+        """
+        Returns a value stored with a finished stage.
+        """
+        return self.stages[stage][key]
+
+    def entries(self, stage):
+        """
+        Returns the manifest entries of a finished stage's outputs.
+        """
+        return [dict((k, v) for k, v in i.items() if k != 'path')
+                for i in self.stages[stage]['files']]
+
+    def _save(self):
+        if not self.path:
+            return
+        with open(self.path + PARTIAL_SUFFIX, 'w') as o:
+            json.dump({'inputs': self.inputs, 'stages': self.stages}, o, indent=2, sort_keys=True)
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+
+def archive_inputs(archive, keys, outputs, **options):
+    """
+    Describes a run over members of an archive into `outputs`. The archive's
+    size and mtime are included so a replaced archive invalidates the
+    checkpoints, and the output paths so a moved output does too.
+    """
+    st = os.stat(archive)
+    inputs = {
+        'archive': os.path.abspath(archive),
+        'archive_size': st.st_size,
+        'archive_mtime': st.st_mtime,
+        'keys': list(keys),
+        'outputs': [os.path.abspath(i) for i in outputs]
+    }
+    inputs.update(options)
+    return inputs
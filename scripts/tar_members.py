@@ -0,0 +1,237 @@
+"""
+Access to members of the Sanger results archive.
+
+For uncompressed tars the member data is memory mapped and handed out as
+memoryview slices, so reading a member costs no Python level read calls or
+buffer copies and the page cache is shared between processes reading the
+same archive. BGZF members are inflated block by block straight from the
+mapping while a background thread reads ahead of the consumer (see
+buffered_io.py). Compressed tars (and sparse members) fall back to tarfile,
+reading the archive through a large buffer.
+"""
+from contextlib import contextmanager
+import gzip
+import mmap
+import struct
+import tarfile
+import zlib
+
+from buffered_io import ReadAhead, open_read, prefetch
+
+# Chunk size when copying a member or reading through tarfile
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Magic numbers of the compressions tarfile can read transparently
+COMPRESSED_MAGIC = (b'\x1f\x8b', b'BZh', b'\xfd7zXZ\x00')
+
+# Per process cache of index_archive() results, keyed by archive path
+_ARCHIVE_INDEX = {}
+
+def is_uncompressed_tar(archive):
+    """
+    True if the archive is a plain tar whose members can be memory mapped.
+    """
+    with open(archive, 'rb') as fh:
+        magic = fh.read(6)
+    return not any(magic.startswith(i) for i in COMPRESSED_MAGIC)
+
+@contextmanager
+def open_tar(archive):
+    """
+    Opens the archive with tarfile. Compressed archives are read through a
+    large buffer since the whole stream is inflated anyway; plain tars are
+    not, as tarfile seeks from header to header and would discard most of
+    each buffer fill.
+    """
+    if is_uncompressed_tar(archive):
+        with tarfile.open(archive, 'r') as tar_fh:
+            yield tar_fh
+        return
+    fh = open_read(archive)
+    try:
+        with tarfile.open(fileobj=fh, mode='r') as tar_fh:
+            yield tar_fh
+    finally:
+        fh.close()
+
+def index_archive(archive):
+    """
+    Scans the archive once and returns (names, spans, members): all member
+    names in archive order, the (offset, size) data span of every member
+    that can be memory mapped and the (name, offset, size) of every member.
+    For compressed archives the offsets are into the decompressed tar. The
+    result is cached per process, so every lookup of keys and members of the
+    archive shares a single scan.
+    """
+    if archive not in _ARCHIVE_INDEX:
+        names = []
+        spans = {}
+        members = []
+        mappable = is_uncompressed_tar(archive)
+        with open_tar(archive) as tar_fh:
+            for member in tar_fh:
+                names.append(member.name)
+                members.append((member.name, member.offset_data, member.size))
+                if mappable and member.isfile() and not member.issparse():
+                    spans[member.name] = (member.offset_data, member.size)
+        _ARCHIVE_INDEX[archive] = (names, spans, members)
+    return _ARCHIVE_INDEX[archive]
+
+def load_archive_index(archive, index):
+    """
+    Seeds the cache with an index_archive() result from another process.
+    """
+    _ARCHIVE_INDEX[archive] = index
+
+def list_members(archive):
+    """
+    Returns the names of all members of the archive.
+    """
+    return index_archive(archive)[0]
+
+def list_member_info(archive):
+    """
+    Returns the (name, offset, size) of all members of the archive.
+    """
+    return index_archive(archive)[2]
+
+def get_member_span(archive, key):
+    """
+    Returns the (offset, size) of the member's data in the archive, or None
+    if the member can't be memory mapped.
+    """
+    return index_archive(archive)[1].get(key)
+
+def prefetch_member(archive, key):
+    """
+    Hints the kernel to start reading a member that will be needed next.
+    A no-op for members that can't be memory mapped.
+    """
+    span = get_member_span(archive, key)
+    if span is not None:
+        prefetch(archive, *span)
+
+@contextmanager
+def member_view(archive, span):
+    """
+    Memory maps the (offset, size) span of the archive and yields it as a
+    read only memoryview.
+    """
+    offset, size = span
+    if size == 0:
+        yield memoryview(b'')
+        return
+    # mmap offsets must be aligned to the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    with open(archive, 'rb') as fh:
+        mapped = mmap.mmap(fh.fileno(), size + offset - start, offset=start,
+                           access=mmap.ACCESS_READ)
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    view = memoryview(mapped)[offset - start:]
+    try:
+        yield view
+    finally:
+        view.release()
+        try:
+            mapped.close()
+        except BufferError:
+            # A caller still holds a slice; the mapping goes away with it.
+            pass
+
+def iter_member_chunks(archive, key, span=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the raw data of a member in chunks. Chunks are memoryview slices
+    of the mapped archive when possible, so they must not be kept around
+    after the next chunk is requested.
+    """
+    span = span or get_member_span(archive, key)
+    if span is None:
+        with open_tar(archive) as tar_fh:
+            fobj = tar_fh.extractfile(key)
+            try:
+                while True:
+                    chunk = fobj.read(chunk_size)
+                    if not chunk: break
+                    yield chunk
+            finally:
+                fobj.close()
+        return
+
+    with member_view(archive, span) as view, ReadAhead(archive, *span) as read_ahead:
+        for i in range(0, len(view), chunk_size):
+            chunk = view[i:i + chunk_size]
+            yield chunk
+            chunk.release()
+            read_ahead.advance(i + chunk_size)
+
+def iter_member_lines(archive, key, span=None):
+    """
+    Yields the lines (bytes) of a plain text member of the archive.
+    """
+    rest = b''
+    for chunk in iter_member_chunks(archive, key, span):
+        lines = (rest + bytes(chunk)).split(b'\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if rest:
+        yield rest
+
+def is_bgzf_block(view, pos):
+    """
+    True if a BGZF block header starts at pos.
+    """
+    return (len(view) - pos >= 18 and bytes(view[pos:pos + 4]) == b'\x1f\x8b\x08\x04'
+            and bytes(view[pos + 10:pos + 16]) == b'\x06\x00BC\x02\x00')
+
+def iter_bgzf_blocks(view, read_ahead=None):
+    """
+    Yields the inflated data of each BGZF block in the view, reporting the
+    progress to `read_ahead` if given.
+    """
+    pos = 0
+    while pos < len(view):
+        if not is_bgzf_block(view, pos):
+            raise ValueError('Invalid BGZF block at offset {0}'.format(pos))
+        bsize = struct.unpack_from('<H', view, pos + 16)[0] + 1
+        crc, isize = struct.unpack_from('<II', view, pos + bsize - 8)
+        data = zlib.decompress(view[pos + 18:pos + bsize - 8], -15)
+        if len(data) != isize or zlib.crc32(data) & 0xffffffff != crc:
+            raise ValueError('Corrupt BGZF block at offset {0}'.format(pos))
+        if data:
+            yield data
+        pos += bsize
+        if read_ahead is not None:
+            read_ahead.advance(pos)
+
+def iter_bgzf_member_lines(archive, key, span=None):
+    """
+    Yields the decompressed lines (bytes) of a bgzipped member of the archive.
+    """
+    span = span or get_member_span(archive, key)
+    if span is not None:
+        with member_view(archive, span) as view, ReadAhead(archive, *span) as read_ahead:
+            bgzf = is_bgzf_block(view, 0) or len(view) == 0
+            if bgzf:
+                rest = b''
+                for data in iter_bgzf_blocks(view, read_ahead):
+                    lines = data.split(b'\n')
+                    lines[0] = rest + lines[0]
+                    rest = lines.pop()
+                    for line in lines:
+                        yield line + b'\n'
+                if rest:
+                    yield rest
+        if bgzf:
+            return
+
+    # Plain gzip member or compressed archive
+    with open_tar(archive) as tar_fh:
+        fobj = tar_fh.extractfile(key)
+        try:
+            with gzip.GzipFile(fileobj=fobj, mode='rb') as reader:
+                for line in reader:
+                    yield line
+        finally:
+            fobj.close()
@@ -0,0 +1,180 @@
+"""
+Single pass VCF normalization engine.
+
+Takes the lines of a bgzipped VCF streamed straight out of the results
+archive (see tar_members.iter_bgzf_member_lines), applies a chain
+of header transforms and record filters, and writes the result in one pass.
+This replaces extracting the raw VCF to a tmp file and, for caveman, the
+separate remove_nonstandard_variants.py run over the extracted VCF.
+
+Header transforms take and return the list of header lines (str, without
+newlines). Record filters are (reason, predicate) pairs where the predicate
+gets the first columns of a data line as bytes and returns True if the
+record should be removed. The first matching filter wins.
+"""
+import os
+import threading
+
+import pysam
+
+from buffered_io import get_config
+from filtered_records import REF_EQUALS_ALT, NONSTANDARD_ALLELE
+
+# Allowed bases for the non-standard allele filter
+GOOD_BASES = frozenset(b'ACGTacgt')
+
+def rename_tumour_sample(header):
+    """
+    Renames the TUMOUR sample to TUMOR.
+    """
+    new_header = []
+    for line in header:
+        if line.startswith('##SAMPLE=<ID=TUMOUR'):
+            line = line.replace('ID=TUMOUR', 'ID=TUMOR')
+        elif line.startswith('#CHROM'):
+            line = line.replace('TUMOUR', 'TUMOR')
+        new_header.append(line)
+    return new_header
+
+def ref_equals_alt(cols):
+    """
+    BINF-306: rare case of alt == ref in caveman vcf.
+    """
+    return cols[3] == cols[4]
+
+def nonstandard_allele(cols):
+    """
+    True if any allele has a base other than ACGT.
+    """
+    alleles = cols[3] if cols[4] == b'.' else cols[3] + cols[4].replace(b',', b'')
+    return not GOOD_BASES.issuperset(alleles)
+
+class HtslibWriter(object):
+    """
+    Writer that re-serializes a VCF through htslib before writing it to
+    `writer`, the way remove_nonstandard_variants.py writes its output:
+    the header gets htslib's PASS filter line and values are reformatted,
+    e.g. QUAL 30.0 becomes 30 and FORMAT floats 1.50 and 2.1e-02 become
+    1.5 and 0.021. The lines are piped to a thread that parses them with
+    pysam and writes the records out.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self._error = None
+        read_fd, write_fd = os.pipe()
+        self._thread = threading.Thread(target=self._run, args=(read_fd,), name='htslib-writer')
+        self._thread.daemon = True
+        self._thread.start()
+        self._fh = open(write_fd, 'wb', buffering=get_config()['write_buffer_size'])
+
+    def _run(self, read_fd):
+        """
+        Thread body, parses the piped VCF and writes the header and records.
+        """
+        with open(read_fd, 'rb') as fh:
+            try:
+                reader = pysam.VariantFile(fh)
+                try:
+                    self.writer.write(str(reader.header).encode('utf-8'))
+                    for record in reader:
+                        self.writer.write_record(str(record).encode('utf-8'))
+                finally:
+                    reader.close()
+            except Exception as e:
+                self._error = e
+
+    def write(self, data):
+        try:
+            self._fh.write(data)
+        except BrokenPipeError:
+            self.close()
+            raise
+
+    def write_record(self, data):
+        self.write(data)
+
+    def close(self):
+        """
+        Flushes the pipe and waits for the thread, raising its error if any.
+        """
+        if self._thread is None:
+            return
+        try:
+            self._fh.close()
+        except BrokenPipeError:
+            pass
+        self._thread.join()
+        self._thread = None
+        if self._error is not None:
+            raise self._error
+
+class VcfFilterChain(object):
+    """
+    Applies header transforms and record filters to a stream of VCF lines.
+    With `reserialize`, the kept records are written through htslib (see
+    HtslibWriter) instead of as is.
+    """
+    def __init__(self, header_transforms=(), record_filters=(), reserialize=False):
+        self.header_transforms = list(header_transforms)
+        self.record_filters = list(record_filters)
+        self.reserialize = reserialize
+
+    def _write_header(self, header, writer):
+        for transform in self.header_transforms:
+            header = transform(header)
+        writer.write(''.join(line + '\n' for line in header).encode('utf-8'))
+
+    def run(self, lines, writer, filtered=None):
+        """
+        Processes the lines (bytes) of a VCF, writing kept records to `writer`
+        (an output_manifest.OutputFile) and removed records to `filtered`
+        (a filtered_records.FilteredRecordLog, required when filtering).
+        """
+        if not self.reserialize:
+            self._run(lines, writer, filtered)
+            return
+        htslib_writer = HtslibWriter(writer)
+        try:
+            self._run(lines, htslib_writer, filtered)
+        finally:
+            htslib_writer.close()
+
+    def _run(self, lines, writer, filtered):
+        header = []
+        in_header = True
+        for line in lines:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            if in_header:
+                if line.startswith(b'#'):
+                    header.append(line[:-1].decode('utf-8'))
+                    continue
+                self._write_header(header, writer)
+                in_header = False
+
+            if self.record_filters:
+                cols = line.split(b'\t', 5)
+                removed = False
+                for reason, predicate in self.record_filters:
+                    if predicate(cols):
+                        filtered.add(reason, *[i.decode('utf-8') for i in cols[:2] + cols[3:5]])
+                        removed = True
+                        break
+                if removed:
+                    continue
+            writer.write_record(line)
+
+        if in_header:
+            self._write_header(header, writer)
+
+def caveman_filter_chain(remove_nonstandard=False):
+    """
+    The caveman chain: TUMOUR -> TUMOR and ref == alt removal, optionally
+    fused with the non-ACGT allele filter of remove_nonstandard_variants.py.
+    The fused chain writes through htslib like remove_nonstandard_variants.py
+    does, so its output is the same as running it on the extracted VCF.
+    """
+    record_filters = [(REF_EQUALS_ALT, ref_equals_alt)]
+    if remove_nonstandard:
+        record_filters.append((NONSTANDARD_ALLELE, nonstandard_allele))
+    return VcfFilterChain([rename_tumour_sample], record_filters, reserialize=remove_nonstandard)